@@ -0,0 +1,20 @@
+import os
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BENCH_DIR, "data")
+DEFAULT_DB = os.path.join(DATA_DIR, "bench.db")
+
+PASSWORD = "bench-password"
+
+
+# db.configはimport時にenvを読むので、appやmodelsをimportする前に呼ぶ
+def configure(db_path: str):
+    os.environ["DATABASE_URL"] = "sqlite:///{}?check_same_thread=false".format(os.path.abspath(db_path))
+    os.environ.setdefault("JWT_SECRET_KEY", "bench-secret")
+    os.environ.setdefault("JWT_ACCESS_TOKEN_EXPIRE_MINUTES", "60")
+    # 計測中のflushが結果に混ざらないようにする
+    os.environ.setdefault("COUNTER_FLUSH_INTERVAL", "3600")
+
+
+def username(user_id: int):
+    return "bench{}".format(user_id)
@@ -0,0 +1,109 @@
+# seedしたSQLiteでnotice_crudの主要なqueryのEXPLAIN QUERY PLANを確認する
+#
+#   python -m bench.seed && python -m bench.query_plans
+#
+# 対象のtableをindexなしでSCANしているqueryがあればexit code 1
+import argparse
+import json
+import sys
+
+from .common import DEFAULT_DB, configure
+
+# lookup用のindexを使うべきtable
+WATCHED_TABLES = ("notices", "notice_comment", "notice_like", "notice_file")
+
+
+def checks(notice_crud, notice_id: int, owner_id: int, comment_id: int):
+    from routers.utils.storage import unreferenced_blobs
+
+    return {
+        "get_comments": lambda db: notice_crud.get_comments(db, notice_id=notice_id, limit=20),
+        "get_comments_keyset": lambda db: notice_crud.get_comments(db, notice_id=notice_id, limit=20,
+                                                                   before_id=comment_id),
+        "get_comment": lambda db: notice_crud.get_comment(db, comment_id=comment_id, owner_id=owner_id),
+        "get_notice_like_hate": lambda db: notice_crud.get_notice_like_hate(db, notice_id=notice_id,
+                                                                            owner_id=owner_id),
+        "get_notice_files": lambda db: notice_crud.get_notice_files(db, notice_id=notice_id),
+        "get_owned_notice": lambda db: notice_crud.get_owned_notice(db, notice_id=notice_id, owner_id=owner_id),
+        "build_notice": lambda db: notice_crud.build_notice(db, notice_id=notice_id),
+        "toggle_notice_like": lambda db: notice_crud.toggle_notice_like(db, notice_id=notice_id, owner_id=owner_id),
+        "delete_notice": lambda db: notice_crud.delete_notice(db, notice_id=notice_id),
+        "unreferenced_blobs": lambda db: unreferenced_blobs(db, ["0" * 64]),
+    }
+
+
+# 実行されたSQLを記録し、最後にrollbackする (commitはouter transactionの中で行われる)
+def capture(engine, fn):
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(("EXPLAIN", "SAVEPOINT", "RELEASE", "ROLLBACK")):
+            statements.append((statement, parameters))
+
+    connection = engine.connect()
+    outer = connection.begin()
+    event.listen(connection, "before_cursor_execute", record)
+    db = Session(bind=connection)
+    try:
+        fn(db)
+    finally:
+        event.remove(connection, "before_cursor_execute", record)
+        db.close()
+        plans = [(statement, explain(connection, statement, parameters)) for statement, parameters in statements]
+        outer.rollback()
+        connection.close()
+    return plans
+
+
+def explain(connection, statement: str, parameters):
+    return [row[3] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+
+
+def is_scan(detail: str):
+    parts = detail.split()
+    return len(parts) >= 2 and parts[0] == "SCAN" and parts[1] in WATCHED_TABLES \
+        and "COVERING INDEX" not in detail and "USING INDEX" not in detail
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that hot notice queries use index lookups")
+    parser.add_argument("--db", default=DEFAULT_DB)
+    parser.add_argument("--verbose", action="store_true", help="print every plan")
+    args = parser.parse_args()
+
+    configure(args.db)
+
+    from sqlalchemy import func
+    from db.session import SessionLocal, get_engine
+    from routers.models import Comments
+    from routers.utils import notice_crud
+
+    db = SessionLocal()
+    try:
+        comment = db.query(Comments).order_by(func.random()).first()
+    finally:
+        db.close()
+    if comment is None:
+        sys.exit("{} has no comments, run python -m bench.seed first".format(args.db))
+
+    report = {}
+    failed = False
+    for name, fn in checks(notice_crud, comment.notice_id, comment.owner_id, comment.id).items():
+        plans = capture(get_engine(), fn)
+        scans = [detail for _, details in plans for detail in details if is_scan(detail)]
+        failed = failed or bool(scans)
+        report[name] = {"ok": not scans, "scans": scans}
+        if args.verbose:
+            report[name]["plans"] = [{"sql": " ".join(statement.split()), "plan": details}
+                                     for statement, details in plans]
+        print("{:<22} {}".format(name, "ok" if not scans else "SCAN: " + "; ".join(scans)), file=sys.stderr)
+
+    print(json.dumps(report, indent=2))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+# seedしたDBに対してmain.appをin-processで呼び、scenarioごとのthroughputとlatencyを計測する
+#
+#   python -m bench.seed
+#   python -m bench.run --requests 500 --concurrency 8 --output bench/data/result.json
+#   python -m bench.run --baseline bench/data/result.json --tolerance 0.1
+#
+# baselineより p95が悪化 / throughputが低下 したscenarioがあればexit code 1
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import uuid
+
+from .common import DEFAULT_DB, PASSWORD, configure, username
+
+
+def percentile(values, p: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class Context:
+
+    def __init__(self, client, rng, notices: int, files: int, users: int, tokens: dict):
+        self.client = client
+        self.rng = rng
+        self.notices = notices
+        self.files = files
+        self.users = users
+        self.tokens = tokens
+
+    def notice_id(self):
+        return self.rng.randint(1, self.notices)
+
+    def user_id(self):
+        return self.rng.randint(1, self.users)
+
+    # login済みuser (計測前にloginしておき、login時間を他のscenarioに含めない)
+    def logged_in_user(self):
+        return self.rng.choice(list(self.tokens))
+
+    def auth(self, user_id: int):
+        return {"Authorization": "Bearer " + self.tokens[user_id]}
+
+
+async def login_users(client, users: int):
+    tokens = {}
+    for user_id in range(1, users + 1):
+        response = await client.post("/auth/login", json={"username": username(user_id), "password": PASSWORD})
+        response.raise_for_status()
+        tokens[user_id] = response.json()["access_token"]
+    return tokens
+
+
+def check(response, *expected):
+    if response.status_code not in (expected or (200,)):
+        raise RuntimeError("{} {} -> {}".format(response.request.method, response.request.url, response.status_code))
+    return response
+
+
+async def notice_list(ctx: Context):
+    check(await ctx.client.get("/notices/", params={"page": ctx.rng.randint(1, 10), "size": 20}))
+
+
+async def notice_detail(ctx: Context):
+    check(await ctx.client.get("/notices/{}".format(ctx.notice_id())))
+
+
+async def like_toggle(ctx: Context):
+    headers = ctx.auth(ctx.logged_in_user())
+    check(await ctx.client.post("/notices/{}/like".format(ctx.notice_id()), headers=headers))
+
+
+async def comment_crud(ctx: Context):
+    user_id = ctx.logged_in_user()
+    headers = ctx.auth(user_id)
+    notice_id = ctx.notice_id()
+    text = uuid.uuid4().hex
+    response = check(await ctx.client.post("/notices/{}/comment".format(notice_id), headers=headers,
+                                           json={"comment": text, "notice_id": notice_id}))
+    comment_id = next(item["id"] for item in response.json()["items"]
+                      if item["comment"] == text and item["owner_id"] == user_id)
+    check(await ctx.client.put("/notices/{}/comment/{}".format(notice_id, comment_id), headers=headers,
+                               json={"comment": text + " edited"}))
+    check(await ctx.client.delete("/notices/{}/comment/{}".format(notice_id, comment_id), headers=headers))
+
+
+async def login(ctx: Context):
+    check(await ctx.client.post("/auth/login", json={"username": username(ctx.user_id()), "password": PASSWORD}))
+
+
+async def file_download(ctx: Context):
+    response = check(await ctx.client.get("/notices/file/download/{}".format(ctx.rng.randint(1, ctx.files))))
+    response.read()
+
+
+SCENARIOS = {
+    "list": notice_list,
+    "detail": notice_detail,
+    "like_toggle": like_toggle,
+    "comment_crud": comment_crud,
+    "login": login,
+    "download": file_download,
+}
+
+
+async def run_scenario(ctx: Context, scenario, requests: int, concurrency: int, warmup: int):
+    for _ in range(warmup):
+        await scenario(ctx)
+
+    latencies = []
+    errors = []
+    remaining = iter(range(requests))
+
+    async def worker():
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                await scenario(ctx)
+            except Exception as e:
+                errors.append(str(e))
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    to_ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "requests": requests,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "mean_ms": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": to_ms(percentile(latencies, 50)),
+        "p95_ms": to_ms(percentile(latencies, 95)),
+        "p99_ms": to_ms(percentile(latencies, 99)),
+        "max_ms": to_ms(max(latencies)) if latencies else None,
+    }
+
+
+async def run(args):
+    configure(args.db)
+
+    # 重複SQLのwarningが結果の表示に混ざらないようにする
+    logging.getLogger("db.queries").setLevel(logging.ERROR)
+
+    import httpx
+    from sqlalchemy import func
+    from db.session import SessionLocal
+    from routers.models import NoticeFile, Notices, Users
+    from main import app
+
+    db = SessionLocal()
+    try:
+        notices = db.query(func.max(Notices.id)).scalar() or 0
+        files = db.query(func.max(NoticeFile.id)).scalar() or 0
+        users = db.query(func.max(Users.id)).scalar() or 0
+    finally:
+        db.close()
+    if not notices or not users:
+        sys.exit("{} is empty, run python -m bench.seed first".format(args.db))
+
+    names = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+    if not files and "download" in names:
+        names.remove("download")
+
+    results = {}
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    # ASGITransportはlifespanを送らないので、startup/shutdown (routerの登録とcounterのflush) はここで行う
+    async with app.router.lifespan_context(app), \
+            httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        tokens = await login_users(client, min(users, args.login_users))
+        for name in names:
+            ctx = Context(client, random.Random(args.seed), notices=notices, files=files, users=users, tokens=tokens)
+            results[name] = await run_scenario(ctx, SCENARIOS[name], args.requests, args.concurrency, args.warmup)
+            print("{:<14} {:>9} rps  p50 {:>9} ms  p95 {:>9} ms  p99 {:>9} ms  errors {}".format(
+                name, results[name]["throughput_rps"], results[name]["p50_ms"],
+                results[name]["p95_ms"], results[name]["p99_ms"], results[name]["errors"]), file=sys.stderr)
+
+    return {
+        "meta": {
+            "db": args.db,
+            "notices": notices,
+            "users": users,
+            "files": files,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "scenarios": results,
+    }
+
+
+# p95の増加とthroughputの低下がtoleranceを超えたものを返す
+def compare(result: dict, baseline: dict, tolerance: float):
+    regressions = []
+    for name, current in result["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        if before.get("p95_ms") and current.get("p95_ms") is not None \
+                and current["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append("{}: p95 {} ms -> {} ms".format(name, before["p95_ms"], current["p95_ms"]))
+        if before.get("throughput_rps") and current.get("throughput_rps") is not None \
+                and current["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            regressions.append("{}: throughput {} rps -> {} rps".format(
+                name, before["throughput_rps"], current["throughput_rps"]))
+        if current["errors"] > before.get("errors", 0):
+            regressions.append("{}: errors {} -> {}".format(name, before.get("errors", 0), current["errors"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the in-process API benchmark")
+    parser.add_argument("--db", default=DEFAULT_DB)
+    parser.add_argument("--scenarios", help="comma separated: " + ",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--login-users", type=int, default=10, help="users logged in before measuring")
+    parser.add_argument("--output", help="write the JSON result to this file (default: stdout)")
+    parser.add_argument("--baseline", help="compare against a previous JSON result")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.scenarios:
+        unknown = set(args.scenarios.split(",")) - set(SCENARIOS)
+        if unknown:
+            parser.error("unknown scenarios: {}".format(",".join(sorted(unknown))))
+
+    result = asyncio.run(run(args))
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(result, baseline, args.tolerance)
+        result["baseline"] = {"path": args.baseline, "tolerance": args.tolerance, "regressions": regressions}
+        for regression in regressions:
+            print("REGRESSION " + regression, file=sys.stderr)
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(output + "\n")
+    else:
+        print(output)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# benchmark用のSQLite DBをrouters/models.pyのtableで作る
+#
+#   python -m bench.seed --notices 1000000 --likes 10000000 --comments 5000000
+#
+# 同じ引数(--seed)なら同じデータになる
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from .common import DATA_DIR, DEFAULT_DB, PASSWORD, configure, username
+
+CHUNK = 10000
+
+
+def chunks(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= CHUNK:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def insert(conn, table, rows, total: int):
+    started = time.perf_counter()
+    done = 0
+    for batch in chunks(rows):
+        conn.execute(table.insert(), batch)
+        done += len(batch)
+        if done % (CHUNK * 100) == 0:
+            print("  {} {}/{}".format(table.name, done, total), file=sys.stderr)
+    print("{}: {} rows in {:.1f}s".format(table.name, done, time.perf_counter() - started), file=sys.stderr)
+
+
+def seed(args):
+    configure(args.db)
+
+    from db import migrations
+    from db.session import Base, get_engine
+    from routers.models import Comments, NoticeFile, NoticeLike, Notices, Users
+    from routers.users.passwords import password_context
+
+    rng = random.Random(args.seed)
+    epoch = datetime(2020, 1, 1)
+    # likeは(notice_id, owner_id)が重複しないように割り当てるので、userはlike数/notice数以上必要
+    users = max(args.users, -(-args.likes // max(args.notices, 1)))
+
+    engine = get_engine()
+    Base.metadata.drop_all(bind=engine)
+    migrations.schema_version.drop(bind=engine, checkfirst=True)
+    migrations.upgrade(engine)
+
+    # 10Mのlikeをメモリに持たないよう、同じseedで2回生成する (1回目はcounterの集計)
+    def generate_likes():
+        like_rng = random.Random(args.seed + 1)
+        for i in range(args.likes):
+            yield i % args.notices + 1, i // args.notices + 1, like_rng.random() < 0.8
+
+    def generate_comments():
+        comment_rng = random.Random(args.seed + 2)
+        for _ in range(args.comments):
+            yield comment_rng.randint(1, args.notices), comment_rng.randint(1, users)
+
+    like_cnt = [0] * (args.notices + 1)
+    hate_cnt = [0] * (args.notices + 1)
+    comment_cnt = [0] * (args.notices + 1)
+    for notice_id, _, is_like in generate_likes():
+        if is_like:
+            like_cnt[notice_id] += 1
+        else:
+            hate_cnt[notice_id] += 1
+    for notice_id, _ in generate_comments():
+        comment_cnt[notice_id] += 1
+
+    os.makedirs(os.path.join(DATA_DIR, "files"), exist_ok=True)
+    payload = rng.randbytes(args.file_size) if hasattr(rng, "randbytes") else os.urandom(args.file_size)
+
+    hashed = password_context.hash(PASSWORD)
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            conn.exec_driver_sql("PRAGMA synchronous=OFF")
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+
+        insert(conn, Users.__table__, ({
+            "id": user_id,
+            "email": "{}@bench.local".format(username(user_id)),
+            "username": username(user_id),
+            "first_name": "bench",
+            "last_name": str(user_id),
+            "hashed_password": hashed,
+            "is_active": True,
+            "is_staff": user_id == 1,
+        } for user_id in range(1, users + 1)), users)
+
+        insert(conn, Notices.__table__, ({
+            "id": notice_id,
+            "title": "notice {}".format(notice_id),
+            "content": "benchmark notice {} ".format(notice_id) * 8,
+            "views": rng.randint(0, 1000),
+            "like_cnt": like_cnt[notice_id],
+            "hate_cnt": hate_cnt[notice_id],
+            "comment_cnt": comment_cnt[notice_id],
+            "created_at": epoch + timedelta(minutes=notice_id),
+            "updated_at": epoch + timedelta(minutes=notice_id),
+            "owner_id": rng.randint(1, users),
+        } for notice_id in range(1, args.notices + 1)), args.notices)
+
+        insert(conn, NoticeLike.__table__, ({
+            "id": like_id,
+            "like": int(is_like),
+            "hate": int(not is_like),
+            "owner_id": owner_id,
+            "notice_id": notice_id,
+        } for like_id, (notice_id, owner_id, is_like) in enumerate(generate_likes(), 1)), args.likes)
+
+        insert(conn, Comments.__table__, ({
+            "id": comment_id,
+            "comment": "comment {}".format(comment_id),
+            "created_at": epoch + timedelta(seconds=comment_id),
+            "updated_at": epoch + timedelta(seconds=comment_id),
+            "owner_id": owner_id,
+            "notice_id": notice_id,
+        } for comment_id, (notice_id, owner_id) in enumerate(generate_comments(), 1)), args.comments)
+
+        files = []
+        for file_id in range(1, args.files + 1):
+            path = os.path.join(DATA_DIR, "files", "bench-{}.bin".format(file_id))
+            with open(path, "wb") as fp:
+                fp.write(payload)
+            files.append({
+                "id": file_id,
+                "path": path,
+                "file_name": "bench-{}.bin".format(file_id),
+                "file_size": args.file_size,
+                "file_type": 0,
+                "file_download": 0,
+                "created_at": epoch,
+                "updated_at": epoch,
+                "notice_id": rng.randint(1, args.notices),
+            })
+        insert(conn, NoticeFile.__table__, files, args.files)
+
+    print("seeded {} (users={}, notices={}, likes={}, comments={}, files={})".format(
+        args.db, users, args.notices, args.likes, args.comments, args.files))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed the benchmark SQLite database")
+    parser.add_argument("--db", default=DEFAULT_DB)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--notices", type=int, default=10000)
+    parser.add_argument("--likes", type=int, default=100000)
+    parser.add_argument("--comments", type=int, default=50000)
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--file-size", type=int, default=256 * 1024)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+    seed(args)
+
+
+if __name__ == "__main__":
+    main()
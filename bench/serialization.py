@@ -0,0 +1,111 @@
+# notice/comment pageのJSON化をresponse model経由とFAST_JSONで比較する micro benchmark
+#
+#   python -m bench.serialization --items 100 --rounds 200
+#
+# 両方の出力が同じbyte列であることも確認する (違う場合はexit code 1)
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from .common import DEFAULT_DB, configure
+
+
+def percentile(values, p: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def measure(fn, rounds: int):
+    fn()
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def summary(timings, items: int):
+    total = sum(timings)
+    return {"mean_ms": round(total / len(timings) * 1000, 4),
+            "p50_ms": round(percentile(timings, 50) * 1000, 4),
+            "p95_ms": round(percentile(timings, 95) * 1000, 4),
+            "p99_ms": round(percentile(timings, 99) * 1000, 4),
+            "items_per_second": round(items * len(timings) / total, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare response-model and fast JSON serialization")
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    configure(DEFAULT_DB)
+
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from fastapi_pagination import Page, Params
+    from routers.notices.schemas import Comment, NoticeList
+    from routers.utils import fast_json
+
+    epoch = datetime(2020, 1, 1)
+    params = Params(page=1, size=args.items)
+    notices = [SimpleNamespace(id=i, title="notice {} お知らせ".format(i), content="content " * 20, views=i,
+                               created_at=epoch + timedelta(minutes=i), updated_at=epoch + timedelta(minutes=i),
+                               owner_id=1)
+               for i in range(args.items)]
+    comments = [SimpleNamespace(id=i, comment="comment {} コメント".format(i), username="user{}".format(i % 7),
+                                owner_id=i % 7, created_at=epoch + timedelta(seconds=i),
+                                updated_at=epoch + timedelta(seconds=i))
+                for i in range(args.items)]
+
+    cases = {
+        "notice_list": (NoticeList, notices, lambda rows: [row.__dict__ for row in rows]),
+        "comment_page": (Comment, comments, lambda rows: [vars(row) for row in rows]),
+    }
+
+    results = {"meta": {"items": args.items, "rounds": args.rounds, "orjson": fast_json.orjson is not None},
+               "scenarios": {}}
+    identical = True
+    for name, (model, rows, to_items) in cases.items():
+        page_model = Page[model]
+        encode = fast_json.compile_encoder(model)
+
+        # FastAPIがresponse_modelで行う処理 (検証 -> jsonable_encoder -> JSONResponse)
+        def model_path():
+            page = Page.create(items=to_items(rows), total=len(rows) * 10, params=params)
+            return JSONResponse(jsonable_encoder(page_model.validate(page))).body
+
+        def fast_path():
+            return fast_json.FastJSONResponse(
+                fast_json.page_content([encode(row) for row in rows], len(rows) * 10, params)).body
+
+        same = model_path() == fast_path()
+        identical = identical and same
+        model_stats = summary(measure(model_path, args.rounds), args.items)
+        fast_stats = summary(measure(fast_path, args.rounds), args.items)
+        results["scenarios"][name] = {
+            "identical": same,
+            "response_model": model_stats,
+            "fast_json": fast_stats,
+            "speedup": round(model_stats["mean_ms"] / fast_stats["mean_ms"], 2),
+        }
+        print("{:<14} response_model {:>9} ms  fast_json {:>9} ms  x{}  identical={}".format(
+            name, model_stats["mean_ms"], fast_stats["mean_ms"], results["scenarios"][name]["speedup"], same),
+            file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(output + "\n")
+    else:
+        print(output)
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == "__main__":
+    main()
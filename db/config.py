@@ -12,6 +12,98 @@ class Settings:
     DB_DATABASE: str = os.getenv("DB_DATABASE")
     DB_NAME: str = os.getenv("DB_NAME")
 
-    DATABASE_URL = '{}://{}:{}@{}:{}/{}'.format(DB_DATABASE, DB_USERNAME, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME)
+    DATABASE_URL = os.getenv("DATABASE_URL",
+                             '{}://{}:{}@{}:{}/{}'.format(DB_DATABASE, DB_USERNAME, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME))
+
+    # connection pool
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", 10))
+    DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", 3600))
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+    DB_POOL_SLOW_CHECKOUT: float = float(os.getenv("DB_POOL_SLOW_CHECKOUT", 0.1))
+
+    # lifespan startup: poolに作っておくconnection数、未適用migrationの自動適用
+    # DB_STARTUP_STRICT=falseならstartup中のDB errorはlogだけ出してworkerを起動する
+    DB_POOL_WARMUP: int = int(os.getenv("DB_POOL_WARMUP", 0))
+    DB_AUTO_MIGRATE: bool = os.getenv("DB_AUTO_MIGRATE", "false").lower() in ("1", "true", "yes")
+    DB_STARTUP_STRICT: bool = os.getenv("DB_STARTUP_STRICT", "false").lower() in ("1", "true", "yes")
+
+    # request単位のSQL計測 (SQL_DEBUGでresponse headerにも出す)
+    SQL_DEBUG: bool = os.getenv("SQL_DEBUG", "false").lower() in ("1", "true", "yes")
+    SQL_SLOW_REQUEST: float = float(os.getenv("SQL_SLOW_REQUEST", 0.5))
+    SQL_REPEAT_THRESHOLD: int = int(os.getenv("SQL_REPEAT_THRESHOLD", 3))
+    SQL_SLOWEST_KEEP: int = int(os.getenv("SQL_SLOWEST_KEEP", 3))
+
+    # AsyncSessionを使う場合のdriver (例: mysql+aiomysql, sqlite+aiosqlite)
+    DB_ASYNC: bool = os.getenv("DB_ASYNC", "false").lower() in ("1", "true", "yes")
+    DB_ASYNC_DATABASE: str = os.getenv("DB_ASYNC_DATABASE", "mysql+aiomysql")
+    ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL",
+                                   '{}://{}:{}@{}:{}/{}'.format(DB_ASYNC_DATABASE, DB_USERNAME, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME))
+
+    # bcryptのcostとhash用worker pool (thread / process)
+    BCRYPT_ROUNDS: int = int(os.getenv("BCRYPT_ROUNDS", 12))
+    PASSWORD_HASH_POOL: str = os.getenv("PASSWORD_HASH_POOL", "thread")
+    PASSWORD_HASH_WORKERS: int = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+    PASSWORD_HASH_QUEUE: int = int(os.getenv("PASSWORD_HASH_QUEUE", 32))
+
+    # 添付fileの保存先 (fs / local-object)
+    # 内容のsha256をkeyにしてSTORAGE_SHARD_DEPTH段のdirectoryに分けて保存する
+    # 参照がなくなったblobでもSTORAGE_GC_GRACE秒以内に保存されたものは削除しない
+    STORAGE_BACKEND: str = os.getenv("STORAGE_BACKEND", "fs")
+    STORAGE_ROOT: str = os.getenv("STORAGE_ROOT", "")
+    STORAGE_SHARD_DEPTH: int = int(os.getenv("STORAGE_SHARD_DEPTH", 2))
+    STORAGE_SHARD_WIDTH: int = int(os.getenv("STORAGE_SHARD_WIDTH", 2))
+    STORAGE_GC_GRACE: float = float(os.getenv("STORAGE_GC_GRACE", 300))
+    STORAGE_GC_INTERVAL: float = float(os.getenv("STORAGE_GC_INTERVAL", 3600))
+
+    # 添付fileのupload (byte単位)
+    UPLOAD_CHUNK_SIZE: int = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+    UPLOAD_MAX_FILE_SIZE: int = int(os.getenv("UPLOAD_MAX_FILE_SIZE", 50 * 1024 * 1024))
+    UPLOAD_MAX_REQUEST_SIZE: int = int(os.getenv("UPLOAD_MAX_REQUEST_SIZE", 200 * 1024 * 1024))
+
+    # download数などのcounterをDBへ反映する間隔 (秒)
+    COUNTER_FLUSH_INTERVAL: float = float(os.getenv("COUNTER_FLUSH_INTERVAL", 5))
+
+    # 同じuser/IPからの閲覧を1回として数える期間 (秒, 0で無効)
+    NOTICE_VIEW_DEDUP_WINDOW: float = float(os.getenv("NOTICE_VIEW_DEDUP_WINDOW", 600))
+    NOTICE_VIEW_DEDUP_SIZE: int = int(os.getenv("NOTICE_VIEW_DEDUP_SIZE", 100000))
+
+    # GET /notices/{id}/events (SSE): worker間のbroker、接続ごとのqueue長、heartbeat間隔 (秒)
+    EVENT_BROKER: str = os.getenv("EVENT_BROKER", "local")
+    EVENT_QUEUE_SIZE: int = int(os.getenv("EVENT_QUEUE_SIZE", 100))
+    EVENT_HEARTBEAT: float = float(os.getenv("EVENT_HEARTBEAT", 15))
+
+    # GET /notices/batchで1回に指定できるidの数
+    NOTICE_BATCH_MAX: int = int(os.getenv("NOTICE_BATCH_MAX", 100))
+
+    # 削除済みnoticeのpurge (関連行はPURGE_BATCH_SIZE行ずつ削除し、失敗したnoticeは間隔を延ばして再試行)
+    PURGE_INTERVAL: float = float(os.getenv("PURGE_INTERVAL", 5))
+    PURGE_BATCH_SIZE: int = int(os.getenv("PURGE_BATCH_SIZE", 1000))
+    PURGE_RETRY_BASE: float = float(os.getenv("PURGE_RETRY_BASE", 5))
+    PURGE_RETRY_MAX: float = float(os.getenv("PURGE_RETRY_MAX", 600))
+
+    # 全文検索 (auto / mysql / sqlite / memory)
+    SEARCH_BACKEND: str = os.getenv("SEARCH_BACKEND", "auto")
+    SEARCH_FTS_TOKENIZER: str = os.getenv("SEARCH_FTS_TOKENIZER", "trigram")
+
+    # notice/commentのlistをresponse modelを通さずに直接JSONにする
+    FAST_JSON: bool = os.getenv("FAST_JSON", "true").lower() in ("1", "true", "yes")
+
+    # NDJSON import/exportで1 transaction(1 fetch)あたりに扱う行数
+    BULK_CHUNK_SIZE: int = int(os.getenv("BULK_CHUNK_SIZE", 5000))
+
+    REDIS_URL: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+    # 認証userのcache (user id単位)
+    USER_CACHE_SIZE: int = int(os.getenv("USER_CACHE_SIZE", 4096))
+    USER_CACHE_TTL: int = int(os.getenv("USER_CACHE_TTL", 300))
+
+    # notice詳細のcache (memory / local / redis)
+    NOTICE_CACHE_BACKEND: str = os.getenv("NOTICE_CACHE_BACKEND", "memory")
+    NOTICE_CACHE_SIZE: int = int(os.getenv("NOTICE_CACHE_SIZE", 1024))
+    NOTICE_CACHE_TTL: int = int(os.getenv("NOTICE_CACHE_TTL", 60))
+    # 一覧のtotal (このprocessでの作成/削除時は破棄する)
+    NOTICE_COUNT_TTL: float = float(os.getenv("NOTICE_COUNT_TTL", 5))
 
 settings = Settings()
@@ -1,8 +1,30 @@
-from db.session import SessionLocal
+from starlette.concurrency import run_in_threadpool
+from db.session import SessionLocal, AsyncSessionLocal
 
-def get_db():
+
+# sync SessionをAsyncSessionと同じrun_sync()で扱うためのwrapper
+# DB処理はthreadpoolで実行するのでevent loopをblockしない
+class ThreadedSession:
+
+    def __init__(self, session):
+        self.sync_session = session
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_in_threadpool(fn, self.sync_session, *args, **kwargs)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
+
+
+# routerではawait db.run_sync(notice_crud.xxx, ...)でcrudを呼び出す
+async def get_db():
+    if AsyncSessionLocal is not None:
+        async with AsyncSessionLocal() as db:
+            yield db
+        return
+
+    db = ThreadedSession(SessionLocal())
     try:
-        db = SessionLocal()
         yield db
     finally:
-        db.close()
+        await db.close()
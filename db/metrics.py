@@ -0,0 +1,98 @@
+import bisect
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# middlewareが設定するrequest中のroute ("GET /notices/1" など)
+current_route = ContextVar("current_route", default=None)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            buckets = {"le_{}".format(b): c for b, c in zip(self.buckets, self.counts)}
+            buckets["le_inf"] = self.counts[-1]
+            return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class PoolMetrics:
+
+    def __init__(self):
+        self.checkout_seconds = Histogram(LATENCY_BUCKETS)
+        self.timeouts = 0
+        self.slow_checkouts = 0
+
+
+pool_metrics = {"sync": PoolMetrics(), "async": PoolMetrics()}
+
+
+# connection取得にかかった時間とtimeoutを記録する
+# DB_POOL_SLOW_CHECKOUT秒以上かかった場合はrouteと一緒にlogを出す
+class InstrumentedPoolMixin:
+
+    metrics_name = "sync"
+
+    def connect(self):
+        metrics = pool_metrics[self.metrics_name]
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            metrics.timeouts += 1
+            logger.error("connection pool timeout route=%s size=%d overflow=%d",
+                         current_route.get(), self.size(), self.overflow())
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            metrics.checkout_seconds.observe(waited)
+            if waited >= settings.DB_POOL_SLOW_CHECKOUT:
+                metrics.slow_checkouts += 1
+                logger.warning("slow connection checkout %.3fs route=%s checked_out=%d overflow=%d",
+                               waited, current_route.get(), self.checkedout(), self.overflow())
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    metrics_name = "sync"
+
+
+class InstrumentedAsyncQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    metrics_name = "async"
+
+
+def pool_status(name: str, pool):
+    metrics = pool_metrics[name]
+    status = {"pool": pool.__class__.__name__}
+    if isinstance(pool, QueuePool):
+        status.update({"size": pool.size(),
+                       "checked_in": pool.checkedin(),
+                       "checked_out": pool.checkedout(),
+                       "overflow": pool.overflow()})
+    status.update({"timeouts": metrics.timeouts,
+                   "slow_checkouts": metrics.slow_checkouts,
+                   "checkout_seconds": metrics.checkout_seconds.snapshot()})
+    return status
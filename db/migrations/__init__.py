@@ -0,0 +1,103 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select
+
+logger = logging.getLogger(__name__)
+
+schema_version = Table("schema_version", MetaData(),
+                       Column("version", Integer, primary_key=True, autoincrement=False),
+                       Column("name", String(255), nullable=False),
+                       Column("applied_at", DateTime, nullable=False))
+
+MIGRATIONS = []
+
+
+class Migration:
+
+    def __init__(self, version: int, name: str, upgrade):
+        self.version = version
+        self.name = name
+        self.upgrade = upgrade
+
+
+# @migration(1, "baseline") のように登録する (versionの順に適用される)
+# MySQLのDDLは暗黙にcommitされるので、途中で失敗しても再実行できるように存在checkしてから変更する
+def migration(version: int, name: str):
+    def register(upgrade):
+        if any(m.version == version for m in MIGRATIONS):
+            raise ValueError("duplicate migration version {}".format(version))
+        MIGRATIONS.append(Migration(version, name, upgrade))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return upgrade
+    return register
+
+
+def has_column(conn, table: str, column: str):
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def has_index(conn, table: str, name: str):
+    inspector = inspect(conn)
+    existing = inspector.get_indexes(table) + inspector.get_unique_constraints(table)
+    return any(index["name"] == name for index in existing)
+
+
+# modelで定義したIndexがなければCREATE INDEXする
+def ensure_index(conn, table: Table, name: str):
+    if has_index(conn, table.name, name):
+        return False
+    index = next(index for index in table.indexes if index.name == name)
+    index.create(bind=conn)
+    return True
+
+
+def add_column(conn, table: str, column: Column):
+    if has_column(conn, table, column.name):
+        return False
+    ddl = column.type.compile(dialect=conn.dialect)
+    if column.server_default is not None:
+        ddl += " DEFAULT {}".format(column.server_default.arg)
+    if not column.nullable:
+        ddl += " NOT NULL"
+    conn.exec_driver_sql("ALTER TABLE {} ADD COLUMN {} {}".format(table, column.name, ddl))
+    return True
+
+
+def applied_versions(conn):
+    schema_version.create(bind=conn, checkfirst=True)
+    return {row.version for row in conn.execute(select(schema_version.c.version))}
+
+
+def pending_migrations(engine):
+    load_migrations()
+    with engine.begin() as conn:
+        applied = applied_versions(conn)
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def status(engine):
+    load_migrations()
+    with engine.begin() as conn:
+        applied = applied_versions(conn)
+    return [(m.version, m.name, m.version in applied) for m in MIGRATIONS]
+
+
+# 未適用のmigrationを1つずつ別transactionで適用する
+def upgrade(engine, target: int = None):
+    load_migrations()
+    applied = []
+    for m in pending_migrations(engine):
+        if target is not None and m.version > target:
+            break
+        logger.info("applying migration %04d %s", m.version, m.name)
+        with engine.begin() as conn:
+            m.upgrade(conn)
+            conn.execute(schema_version.insert().values(version=m.version, name=m.name,
+                                                        applied_at=datetime.utcnow()))
+        applied.append(m)
+    return applied
+
+
+def load_migrations():
+    from . import versions  # noqa: F401
@@ -0,0 +1,65 @@
+from . import migration, add_column, ensure_index
+
+
+@migration(1, "baseline")
+def baseline(conn):
+    from db.session import Base
+    import routers.models  # noqa: F401
+    # 既存のtableはそのまま (追加分は以降のmigrationで変更する)
+    Base.metadata.create_all(bind=conn, checkfirst=True)
+
+
+@migration(2, "notice_counters")
+def notice_counters(conn):
+    from routers.models import Notices
+    from routers.utils.notice_crud import notice_counts_update
+
+    table = Notices.__table__
+    added = [add_column(conn, table.name, table.c[name]) for name in ("like_cnt", "hate_cnt", "comment_cnt")]
+    if any(added):
+        conn.execute(notice_counts_update())
+
+
+@migration(3, "notice_file_checksum")
+def notice_file_checksum(conn):
+    from routers.models import NoticeFile
+
+    table = NoticeFile.__table__
+    add_column(conn, table.name, table.c.checksum)
+    ensure_index(conn, table, "ix_notice_file_checksum")
+
+
+@migration(4, "notice_like_unique")
+def notice_like_unique(conn):
+    from routers.models import NoticeLike
+    from routers.utils.notice_crud import delete_duplicate_notice_likes, notice_counts_update
+
+    if delete_duplicate_notice_likes(conn):
+        conn.execute(notice_counts_update())
+    ensure_index(conn, NoticeLike.__table__, "uq_notice_like_notice_owner")
+
+
+# get_comments (notice_id + ORDER BY id), get_notice_files, delete_notice, noticesのowner_idの検索用
+@migration(5, "lookup_indexes")
+def lookup_indexes(conn):
+    from routers.models import Comments, NoticeFile, Notices
+
+    ensure_index(conn, Comments.__table__, "ix_notice_comment_notice_id_id")
+    ensure_index(conn, NoticeFile.__table__, "ix_notice_file_notice_id")
+    ensure_index(conn, Notices.__table__, "ix_notices_owner_id")
+
+
+@migration(6, "notice_soft_delete")
+def notice_soft_delete(conn):
+    from routers.models import Notices
+
+    table = Notices.__table__
+    add_column(conn, table.name, table.c.deleted_at)
+    ensure_index(conn, table, "ix_notices_deleted_at")
+
+
+@migration(7, "search_index")
+def search_index(conn):
+    from routers.utils.search import search_index_for
+
+    search_index_for(conn.dialect.name).create_schema(conn)
@@ -0,0 +1,121 @@
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .config import settings
+from .metrics import Histogram, LATENCY_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+# middlewareが設定するrequest単位のQueryStats
+current_queries = ContextVar("current_queries", default=None)
+
+
+# 1 requestで実行したSQLの件数, 時間, 遅いSQL, 繰り返されたSQLを記録する
+class QueryStats:
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+        self.exact = Counter()
+        self.slowest = []
+        self._lock = threading.Lock()
+
+    def record(self, statement: str, parameters, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.seconds += seconds
+            self.statements[statement] += 1
+            self.exact[(statement, repr(parameters))] += 1
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[settings.SQL_SLOWEST_KEEP:]
+
+    # 同じSQLがparameterだけ変えてSQL_REPEAT_THRESHOLD回以上実行された (N+1)
+    def repeated(self):
+        return {statement: n for statement, n in self.statements.items()
+                if n >= settings.SQL_REPEAT_THRESHOLD}
+
+    # SQLもparameterも同じものが2回以上実行された
+    def duplicates(self):
+        return {statement: n for (statement, _), n in self.exact.items() if n > 1}
+
+    def summary(self):
+        return {"queries": self.count,
+                "db_ms": round(self.seconds * 1000, 3),
+                "slowest": [{"ms": round(seconds * 1000, 3), "statement": statement}
+                            for seconds, statement in self.slowest],
+                "repeated": self.repeated(),
+                "duplicates": self.duplicates()}
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    stats = current_queries.get()
+    if stats is not None:
+        stats.record(statement, parameters, time.perf_counter() - started)
+
+
+class RouteMetrics:
+
+    def __init__(self):
+        self.requests = 0
+        self.repeated = 0
+        self.duplicates = 0
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.db_seconds = Histogram(LATENCY_BUCKETS)
+
+    def snapshot(self):
+        return {"requests": self.requests,
+                "requests_with_repeated": self.repeated,
+                "requests_with_duplicates": self.duplicates,
+                "queries": self.queries.snapshot(),
+                "db_seconds": self.db_seconds.snapshot()}
+
+
+route_metrics = {}
+_route_lock = threading.Lock()
+
+
+def observe_request(route: str, status_code: int, stats: QueryStats):
+    repeated = stats.repeated()
+    duplicates = stats.duplicates()
+    with _route_lock:
+        metrics = route_metrics.get(route)
+        if metrics is None:
+            metrics = route_metrics[route] = RouteMetrics()
+        metrics.requests += 1
+        metrics.repeated += bool(repeated)
+        metrics.duplicates += bool(duplicates)
+    metrics.queries.observe(stats.count)
+    metrics.db_seconds.observe(stats.seconds)
+
+    if repeated or duplicates or stats.seconds >= settings.SQL_SLOW_REQUEST:
+        level = logging.WARNING
+    else:
+        level = logging.DEBUG
+    if logger.isEnabledFor(level):
+        record = {"event": "request_sql", "route": route, "status": status_code}
+        record.update(stats.summary())
+        logger.log(level, json.dumps(record, ensure_ascii=False))
+
+
+def query_metrics():
+    with _route_lock:
+        routes = dict(route_metrics)
+    return {route: metrics.snapshot() for route, metrics in sorted(routes.items())}
@@ -1,16 +1,107 @@
+import threading
+
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from .config import settings
-import sqlalchemy
+from .metrics import InstrumentedQueuePool, InstrumentedAsyncQueuePool
 
 
 SQLALCHEMY_DATABASE_URL = settings.DATABASE_URL
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# settingsのpool設定 (sqliteはdialectのdefault poolを使う)
+def pool_options(url: str, poolclass):
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {"poolclass": poolclass,
+            "pool_size": settings.DB_POOL_SIZE,
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+            "pool_timeout": settings.DB_POOL_TIMEOUT,
+            "pool_recycle": settings.DB_POOL_RECYCLE,
+            "pool_pre_ping": settings.DB_POOL_PRE_PING}
+
+
+# engineはimport時ではなく最初に必要になった時 (lifespan startupかSessionLocal()) に作る
+_engine = None
+_async_engine = None
+_engine_lock = threading.Lock()
+
+
+# bindがまだない場合はengine_factoryでengineを作ってからSessionを返すsessionmaker
+class LazySessionMaker(sessionmaker):
+
+    def __init__(self, engine_factory, **kw):
+        super().__init__(**kw)
+        self.engine_factory = engine_factory
+
+    def __call__(self, **local_kw):
+        if self.kw.get("bind") is None:
+            self.engine_factory()
+        return super().__call__(**local_kw)
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(SQLALCHEMY_DATABASE_URL,
+                                        **pool_options(SQLALCHEMY_DATABASE_URL, InstrumentedQueuePool))
+                SessionLocal.configure(bind=_engine)
+    return _engine
+
+
+# DB_ASYNC=falseの場合はNone
+def get_async_engine():
+    global _async_engine
+    if not settings.DB_ASYNC:
+        return None
+    if _async_engine is None:
+        with _engine_lock:
+            if _async_engine is None:
+                from sqlalchemy.ext.asyncio import create_async_engine
+
+                _async_engine = create_async_engine(settings.ASYNC_DATABASE_URL,
+                                                    **pool_options(settings.ASYNC_DATABASE_URL,
+                                                                   InstrumentedAsyncQueuePool))
+                AsyncSessionLocal.configure(bind=_async_engine)
+    return _async_engine
+
+
+# 作成済みのengineのconnectionを全て閉じる (shutdown時)
+async def dispose_engines():
+    global _engine, _async_engine
+    with _engine_lock:
+        engine, _engine = _engine, None
+        async_engine, _async_engine = _async_engine, None
+        SessionLocal.configure(bind=None)
+        if AsyncSessionLocal is not None:
+            AsyncSessionLocal.configure(bind=None)
+    if async_engine is not None:
+        await async_engine.dispose()
+    if engine is not None:
+        engine.dispose()
+
+
+SessionLocal = LazySessionMaker(get_engine, autocommit=False, autoflush=False)
+
+# DB_ASYNC=trueの場合はasync driverのAsyncSessionを使う
+AsyncSessionLocal = None
+if settings.DB_ASYNC:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+    AsyncSessionLocal = LazySessionMaker(get_async_engine, autocommit=False, autoflush=False,
+                                         class_=AsyncSession, expire_on_commit=False)
 
 Base = declarative_base()
 
-metadata = sqlalchemy.MetaData()
+
+# 以前のdb.session.engine / async_engineの参照用 (参照した時点でengineを作る)
+def __getattr__(name):
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
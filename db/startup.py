@@ -0,0 +1,102 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+from . import migrations
+from .config import settings
+from .session import get_async_engine, get_engine
+
+logger = logging.getLogger(__name__)
+
+
+# lifespan startupの各stepの所要時間と結果を記録する
+class StartupReport:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps = []
+        self.seconds = None
+
+    @contextmanager
+    def step(self, name: str, strict: bool = True):
+        started = time.perf_counter()
+        entry = {"step": name, "ok": True, "seconds": None}
+        self.steps.append(entry)
+        try:
+            yield entry
+        except Exception as e:
+            entry["ok"] = False
+            entry["error"] = "{}: {}".format(e.__class__.__name__, e)
+            if strict:
+                raise
+            logger.warning("startup step %s failed: %s", name, entry["error"])
+        finally:
+            entry["seconds"] = round(time.perf_counter() - started, 6)
+            logger.info("startup step %s %.3fs", name, entry["seconds"])
+
+    def finish(self):
+        self.seconds = round(time.perf_counter() - self.started, 6)
+        logger.info("startup finished in %.3fs", self.seconds)
+        return self.as_dict()
+
+    def as_dict(self):
+        return {"seconds": self.seconds,
+                "ok": all(step["ok"] for step in self.steps),
+                "steps": self.steps}
+
+
+# n本のconnectionを同時にcheckoutしてSELECT 1を実行し、poolに戻しておく
+def warm_pool(engine, n: int):
+    connections = []
+    try:
+        for _ in range(n):
+            conn = engine.connect()
+            connections.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in connections:
+            conn.close()
+    return len(connections)
+
+
+async def warm_async_pool(engine, n: int):
+    connections = []
+    try:
+        for _ in range(n):
+            conn = await engine.connect()
+            connections.append(conn)
+            await conn.execute(text("SELECT 1"))
+    finally:
+        for conn in connections:
+            await conn.close()
+    return len(connections)
+
+
+# 未適用のmigrationを返す (DB_AUTO_MIGRATEなら適用する)
+def check_schema(engine):
+    pending = migrations.pending_migrations(engine)
+    if pending and settings.DB_AUTO_MIGRATE:
+        migrations.upgrade(engine)
+        return []
+    for m in pending:
+        logger.warning("migration %04d %s is not applied, run python manage.py migrate", m.version, m.name)
+    return [m.version for m in pending]
+
+
+async def initialize_database(report: StartupReport):
+    strict = settings.DB_STARTUP_STRICT
+    with report.step("engine"):
+        engine = get_engine()
+        async_engine = get_async_engine()
+
+    if settings.DB_POOL_WARMUP > 0:
+        with report.step("pool_warmup", strict=strict) as entry:
+            entry["connections"] = await run_in_threadpool(warm_pool, engine, settings.DB_POOL_WARMUP)
+            if async_engine is not None:
+                entry["async_connections"] = await warm_async_pool(async_engine, settings.DB_POOL_WARMUP)
+
+    with report.step("schema_check", strict=strict) as entry:
+        entry["pending_migrations"] = await run_in_threadpool(check_schema, engine)
@@ -1,15 +1,80 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from routers.users import auth
-from routers.notices import notices
+from starlette.concurrency import run_in_threadpool
+from db.config import settings
+from db.metrics import current_route
+from db.queries import QueryStats, current_queries, observe_request
 from fastapi.middleware.cors import CORSMiddleware
+from routers.utils.upload_limit import MULTIPART_OVERHEAD, UploadSizeLimitMiddleware
 
-app = FastAPI()
+
+# routerのimport (models, passlib, jwtなど) はimport時ではなくstartupで行う
+def include_routers(app: FastAPI):
+    if getattr(app.state, "routers_included", False):
+        return
+    from routers.users import auth
+    from routers.notices import notices
+    from routers import bulk, metrics
+
+    app.include_router(auth.router)
+    app.include_router(notices.router)
+    app.include_router(metrics.router)
+    app.include_router(bulk.router)
+    app.state.routers_included = True
+
+
+# engine作成、pool warm-up、schema確認、counter flusher/purge workerの起動をstartupで行い、
+# 各stepの所要時間をapp.state.startup (GET /metrics/startup) に残す
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from db.session import dispose_engines
+    from db.startup import StartupReport, initialize_database
+
+    report = StartupReport()
+    with report.step("routers"):
+        include_routers(app)
+    await initialize_database(report)
+    with report.step("background_tasks"):
+        from routers.utils.counters import run_counter_flusher
+        from routers.utils.purge import run_purge_worker
+        from routers.utils.storage import run_blob_gc
+        from routers.utils.events import event_broker
+        event_broker.start()
+        app.state.counter_flusher = asyncio.create_task(run_counter_flusher())
+        app.state.purge_worker = asyncio.create_task(run_purge_worker())
+        app.state.blob_gc = asyncio.create_task(run_blob_gc()) if settings.STORAGE_GC_INTERVAL > 0 else None
+    app.state.startup = report.finish()
+
+    yield
+
+    from routers.users.passwords import password_hasher
+    from routers.utils.counters import flush_counters
+    from routers.utils.events import event_broker
+
+    if app.state.blob_gc is not None:
+        app.state.blob_gc.cancel()
+    app.state.purge_worker.cancel()
+    app.state.counter_flusher.cancel()
+    await run_in_threadpool(flush_counters)
+    password_hasher.shutdown()
+    event_broker.stop()
+    await dispose_engines()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     'http://localhost:3000',
     'localhost:3000'
 ]
 
+# 添付fileのrequestはStarletteがbodyをspoolする前にサイズを確認する (CORSより内側に置き、413にもCORS headerを付ける)
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    max_size=settings.UPLOAD_MAX_REQUEST_SIZE + MULTIPART_OVERHEAD
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -18,5 +83,26 @@ app.add_middleware(
     allow_headers=['*']
 )
 
-app.include_router(auth.router)
-app.include_router(notices.router)
+# requestのrouteと実行したSQLをcontextに入れて計測する
+@app.middleware("http")
+async def instrument_request(request, call_next):
+    stats = QueryStats()
+    route_token = current_route.set("{} {}".format(request.method, request.url.path))
+    queries_token = current_queries.set(stats)
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        if settings.SQL_DEBUG:
+            response.headers["x-db-query-count"] = str(stats.count)
+            response.headers["x-db-time-ms"] = "{:.3f}".format(stats.seconds * 1000)
+            response.headers["x-db-repeated-queries"] = str(sum(stats.repeated().values()))
+            response.headers["x-db-duplicate-queries"] = str(sum(stats.duplicates().values()))
+        return response
+    finally:
+        route = request.scope.get("route")
+        template = route.path if route is not None else "unmatched"
+        observe_request("{} {}".format(request.method, template), status_code, stats)
+        current_queries.reset(queries_token)
+        current_route.reset(route_token)
+
@@ -0,0 +1,163 @@
+import argparse
+import json
+import sys
+
+from db.config import settings
+from db import migrations
+from db.session import SessionLocal, get_engine
+from routers.utils import bulk, notice_crud
+from routers.utils.search import rebuild_search_index
+from routers.utils.purge import notice_purger
+from routers.utils.storage import gc_blobs
+
+
+# 未適用のmigrationを適用する (--statusは一覧だけ表示)
+def migrate(args):
+    if args.status:
+        for version, name, applied in migrations.status(get_engine()):
+            print("{:04d} {:<24} {}".format(version, name, "applied" if applied else "pending"))
+        return
+    applied = migrations.upgrade(get_engine(), target=args.target)
+    for m in applied:
+        print("applied {:04d} {}".format(m.version, m.name))
+    if not applied:
+        print("schema is up to date")
+
+
+# notices.like_cnt/hate_cnt/comment_cntを再計算する
+def reconcile_counters(args):
+    db = SessionLocal()
+    try:
+        updated = notice_crud.reconcile_notice_counts(db=db)
+    finally:
+        db.close()
+    print("reconciled {} notices".format(updated))
+
+
+# 重複したlike/hateを削除してunique indexを作る
+def dedupe_likes(args):
+    db = SessionLocal()
+    try:
+        deleted = notice_crud.dedupe_notice_likes(db=db)
+    finally:
+        db.close()
+    print("removed {} duplicate likes".format(deleted))
+
+
+# 全文検索indexを全件から作り直す
+def rebuild_search(args):
+    db = SessionLocal()
+    try:
+        rebuild_search_index(db)
+    finally:
+        db.close()
+    print("rebuilt search index")
+
+
+# notice/comment/likeをNDJSONで書き出す (-はstdout)
+def export_ndjson(args):
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    db = SessionLocal()
+    try:
+        for lines in bulk.export_ndjson(db, bulk.parse_types(args.types), args.chunk_size):
+            out.write(lines)
+    finally:
+        db.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+# NDJSONを読み込み、chunk_size行ごとに1 transactionでINSERTする (-はstdin)
+def import_ndjson(args):
+    def progress(stats):
+        print("  {} lines, inserted {}, invalid {}".format(stats.lines, stats.inserted, stats.invalid),
+              file=sys.stderr)
+
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    db = SessionLocal()
+    try:
+        importer = bulk.NdjsonImporter(db, chunk_size=args.chunk_size, progress=progress)
+        for line in src:
+            importer.add_line(line)
+        result = importer.finish()
+        if args.reconcile:
+            notice_crud.reconcile_notice_counts(db=db)
+        if args.reindex:
+            rebuild_search_index(db)
+    finally:
+        db.close()
+        if src is not sys.stdin:
+            src.close()
+    print(json.dumps(result, indent=2))
+
+
+# NoticeFileから参照されていない添付file(blob)を削除する
+def gc_attachments(args):
+    db = SessionLocal()
+    try:
+        result = gc_blobs(db, batch_size=args.batch_size, grace=args.grace)
+    finally:
+        db.close()
+    print("scanned {scanned} blobs, deleted {deleted}".format(**result))
+
+
+# 削除済みnoticeのcomment/like/添付fileと行を全て削除する
+def purge_notices(args):
+    notice_purger.batch_size = args.batch_size
+    db = SessionLocal()
+    try:
+        while notice_purger.run_once(db, limit=args.limit):
+            print("  backlog {}".format(notice_purger.backlog), file=sys.stderr)
+    finally:
+        db.close()
+    print(json.dumps(notice_purger.stats(), indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Notice project management commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="apply pending schema migrations")
+    migrate_parser.add_argument("--status", action="store_true", help="list migrations without applying")
+    migrate_parser.add_argument("--target", type=int, help="stop after this version")
+    migrate_parser.set_defaults(func=migrate)
+
+    reconcile = subparsers.add_parser("reconcile-counters", help="recompute notice like/hate/comment counters")
+    reconcile.set_defaults(func=reconcile_counters)
+
+    dedupe = subparsers.add_parser("dedupe-likes", help="remove duplicate notice likes and add the unique index")
+    dedupe.set_defaults(func=dedupe_likes)
+
+    search = subparsers.add_parser("rebuild-search-index", help="rebuild the notice full-text search index")
+    search.set_defaults(func=rebuild_search)
+
+    export = subparsers.add_parser("export", help="export notices, comments and likes as NDJSON")
+    export.add_argument("output", nargs="?", default="-")
+    export.add_argument("--types", help="comma separated: " + ",".join(bulk.BULK_TYPES))
+    export.add_argument("--chunk-size", type=int, default=settings.BULK_CHUNK_SIZE)
+    export.set_defaults(func=export_ndjson)
+
+    load = subparsers.add_parser("import", help="import notices, comments and likes from NDJSON")
+    load.add_argument("input", nargs="?", default="-")
+    load.add_argument("--chunk-size", type=int, default=settings.BULK_CHUNK_SIZE)
+    load.add_argument("--reconcile", action="store_true", help="recompute notice counters afterwards")
+    load.add_argument("--reindex", action="store_true", help="rebuild the search index afterwards")
+    load.set_defaults(func=import_ndjson)
+
+    gc = subparsers.add_parser("gc-blobs", help="delete attachment blobs no notice file refers to")
+    gc.add_argument("--batch-size", type=int, default=1000)
+    gc.add_argument("--grace", type=float, default=settings.STORAGE_GC_GRACE,
+                    help="keep blobs stored less than this many seconds ago")
+    gc.set_defaults(func=gc_attachments)
+
+    purge = subparsers.add_parser("purge-notices", help="purge deleted notices with their comments, likes and files")
+    purge.add_argument("--limit", type=int, default=100, help="notices per round")
+    purge.add_argument("--batch-size", type=int, default=settings.PURGE_BATCH_SIZE)
+    purge.set_defaults(func=purge_notices)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
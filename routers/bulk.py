@@ -0,0 +1,71 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.concurrency import run_in_threadpool
+
+from db.config import settings
+from db.session import SessionLocal
+from .users.auth import get_staff_user
+from .utils import bulk, notice_crud
+from .utils.cache import notice_cache, notice_count_cache
+from .utils.search import rebuild_search_index
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["admin"],
+    dependencies=[Depends(get_staff_user)]
+)
+
+
+def types_or_400(types: Optional[str]):
+    try:
+        return bulk.parse_types(types)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+# response中ずっと使うのでrequestのsessionではなく専用のsessionで読む
+def export_stream(types: list, chunk_size: int):
+    db = SessionLocal()
+    try:
+        yield from bulk.export_ndjson(db, types, chunk_size)
+    finally:
+        db.close()
+
+
+# 1行 = {"type": "notice" | "comment" | "like", ...}
+@router.get("/export")
+async def export_ndjson(types: Optional[str] = None
+                        , chunk_size: int = Query(settings.BULK_CHUNK_SIZE, ge=1, le=100000)):
+    return StreamingResponse(export_stream(types_or_400(types), chunk_size),
+                             media_type="application/x-ndjson")
+
+
+# request bodyをstreamで読み、chunk_size行ごとにINSERTする
+# reconcile/reindexを指定するとcounterと全文検索indexを作り直す
+@router.post("/import")
+async def import_ndjson(request: Request
+                        , chunk_size: int = Query(settings.BULK_CHUNK_SIZE, ge=1, le=100000)
+                        , reconcile: bool = False
+                        , reindex: bool = False):
+    db = SessionLocal()
+    importer = bulk.NdjsonImporter(db, chunk_size=chunk_size, progress=bulk.log_progress)
+    try:
+        async for data in request.stream():
+            await run_in_threadpool(importer.feed, data)
+        result = await run_in_threadpool(importer.finish)
+        notice_count_cache.clear()
+        if reconcile:
+            await run_in_threadpool(notice_crud.reconcile_notice_counts, db=db)
+            notice_cache.clear()
+        if reindex:
+            await run_in_threadpool(rebuild_search_index, db)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail={"error": str(getattr(e, "orig", None) or e),
+                                    "stats": importer.stats.as_dict()})
+    finally:
+        await run_in_threadpool(db.close)
+    return result
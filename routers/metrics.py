@@ -0,0 +1,60 @@
+from fastapi import APIRouter, Request
+
+from db.session import get_async_engine, get_engine
+from db.metrics import pool_status
+from db.queries import query_metrics
+
+from .utils.cache import notice_cache, user_cache
+from .users.passwords import password_hasher
+from .utils.counters import counter_stats
+from .utils.events import notice_events
+from .utils.purge import notice_purger
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["metrics"]
+)
+
+# Cache hit/miss/eviction
+@router.get("/cache")
+async def cache_stats():
+    return {"notice": notice_cache.stats(), "user": user_cache.stats()}
+
+# Password hash pool
+@router.get("/password-hash")
+async def password_hash_stats():
+    return password_hasher.stats()
+
+# Write-behind counter (未flush件数とlag)
+@router.get("/counters")
+async def counters():
+    return counter_stats()
+
+# 削除済みnoticeのpurge (未purge件数, 再試行中の件数, error)
+@router.get("/purge")
+async def purge():
+    return notice_purger.stats()
+
+# SSE購読 (購読中の接続数, publish/配信数, queueが溢れてresyncした数)
+@router.get("/events")
+async def events():
+    return notice_events.stats()
+
+# Connection pool (checked out, overflow, checkout時間, timeout)
+@router.get("/pool")
+async def pool():
+    pools = {"sync": pool_status("sync", get_engine().pool)}
+    async_engine = get_async_engine()
+    if async_engine is not None:
+        pools["async"] = pool_status("async", async_engine.sync_engine.pool)
+    return pools
+
+# route単位のSQL件数とDB時間
+@router.get("/sql")
+async def sql():
+    return query_metrics()
+
+# lifespan startupの各stepの所要時間 (engine, pool warm-up, schema確認など)
+@router.get("/startup")
+async def startup(request: Request):
+    return getattr(request.app.state, "startup", None)
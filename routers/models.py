@@ -1,5 +1,5 @@
-from sqlalchemy import ForeignKey, Boolean, Column, Integer, String, DateTime
-from db.session import Base, metadata, engine
+from sqlalchemy import ForeignKey, Boolean, Column, Integer, String, DateTime, Index
+from db.session import Base
 from sqlalchemy.orm import relationship
 
 
@@ -21,13 +21,22 @@ class Users(Base):
 
 class Notices(Base):
     __tablename__ = "notices"
+    __table_args__ = (
+        Index("ix_notices_owner_id", "owner_id"),
+        Index("ix_notices_deleted_at", "deleted_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String)
     content = Column(String)
     views = Column(Integer)
+    like_cnt = Column(Integer, default=0, server_default="0", nullable=False)
+    hate_cnt = Column(Integer, default=0, server_default="0", nullable=False)
+    comment_cnt = Column(Integer, default=0, server_default="0", nullable=False)
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
+    # 削除済み (purge workerが関連行と添付fileを消してから行を削除する)
+    deleted_at = Column(DateTime, nullable=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
 
     owner = relationship("Users", back_populates="notices")
@@ -37,6 +46,9 @@ class Notices(Base):
 
 class NoticeFile(Base):
     __tablename__ = "notice_file"
+    __table_args__ = (
+        Index("ix_notice_file_notice_id", "notice_id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     path = Column(String)
@@ -44,6 +56,7 @@ class NoticeFile(Base):
     file_size = Column(Integer)
     file_type = Column(Integer)
     file_download = Column(Integer)
+    checksum = Column(String(64), index=True)
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
     notice_id = Column(Integer, ForeignKey("notices.id"))
@@ -52,6 +65,9 @@ class NoticeFile(Base):
 
 class Comments(Base):
     __tablename__ = "notice_comment"
+    __table_args__ = (
+        Index("ix_notice_comment_notice_id_id", "notice_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     comment = Column(String)
@@ -65,6 +81,9 @@ class Comments(Base):
 
 class NoticeLike(Base):
     __tablename__ = "notice_like"
+    __table_args__ = (
+        Index("uq_notice_like_notice_owner", "notice_id", "owner_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     like = Column(Integer, default=False)
@@ -74,5 +93,3 @@ class NoticeLike(Base):
 
     owner = relationship("Users", back_populates="notice_like")
     notice = relationship("Notices", back_populates="notice_like")
-
-metadata.create_all(bind=engine)
@@ -1,19 +1,28 @@
-import os
+from urllib.parse import quote
 from typing import List, Optional
 from datetime import datetime
 from ..models import Notices, Users, Comments
-from .schemas import NoticeList, Notice, NoticeCreate, NoticeUpdate, CommentCreate, CommentBase, Comment, NoticeFile, NoticeFileCreate
+from .schemas import NoticeList, Notice, NoticeSearchResult, NoticeCreate, NoticeUpdate, CommentCreate, CommentBase, Comment, NoticeFile, NoticeFileCreate
 from ..utils import notice_crud
-from ..users.auth import get_logged_in_user, get_user
-
-from fastapi import APIRouter, Depends, HTTPException, Response, status, File, UploadFile, Form
-from fastapi.responses import FileResponse
+from ..utils.uploads import save_uploads
+from ..utils.events import notice_events, notice_event_stream
+from ..utils.storage import blob_storage, local_file_path
+from ..utils.fast_json import FastJSONResponse, compile_encoder, page_content
+from ..utils.conditional import make_etag, make_weak_etag, not_modified, not_modified_response, set_validators
+from ..utils.file_response import RangeFileResponse, file_size
+from ..users.auth import get_current_user, get_viewer
+from ..users.schemas import CurrentUser
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status, File, UploadFile, Form
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from db.config import settings
 from db.connection import get_db
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi_jwt_auth import AuthJWT
 from fastapi_jwt_auth.exceptions import AuthJWTException
 
-from fastapi_pagination import Page, paginate, add_pagination
+from fastapi_pagination import Page, Params, add_pagination
 
 router = APIRouter(
     prefix="/notices",
@@ -21,15 +30,74 @@ router = APIRouter(
     responses={404: {"descriptions": "Not found"}}
 )
 
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-FILE_DIR = os.path.join(BASE_DIR, 'static', 'files')
+# FAST_JSONの場合はresponse modelの検証を省略し、DBの行を直接JSONにする
+encode_notice_list = compile_encoder(NoticeList)
+encode_comment = compile_encoder(Comment)
+
+# ETagはページ位置、件数、各noticeのid/updated_atから作る (viewsは含めない)
+# updated_atはlike/hate、添付file、削除では変わらないのでLast-Modifiedは付けず、If-None-Matchだけで判定する
+def notice_list_etag(rows, total: int, params: Params, before_id: Optional[int]):
+    return make_weak_etag("notices", params.page, params.size, before_id, total,
+                          *("{}:{}".format(row.id, row.updated_at) for row in rows))
+
+
+def notice_etag(notice: Notice):
+    return make_weak_etag("notice", notice.id, notice.updated_at, notice.like_cnt, notice.hate_cnt,
+                          *(f.id for f in notice.file or []))
+
 
 # Notice List
+# If-None-Matchがある場合はid/updated_atだけを先に取得し、一致すれば本文を読まずに304を返す
 @router.get("/", response_model=Page[NoticeList])
-async def read_all_by_notice(page: Optional[int] = 0, db: Session = Depends(get_db)):
-    notices = notice_crud.get_notices(db=db)
+async def read_all_by_notice(request: Request
+                            , response: Response
+                            , params: Params = Depends()
+                            , before_id: Optional[int] = None
+                            , db: AsyncSession = Depends(get_db)):
+    list_kw = dict(limit=params.size, offset=(params.page - 1) * params.size, before_id=before_id)
+    total = await db.run_sync(notice_crud.count_notices)
+    if "if-none-match" in request.headers:
+        versions = await db.run_sync(notice_crud.get_notice_versions, **list_kw)
+        etag = notice_list_etag(versions, total, params, before_id)
+        if not_modified(request, etag):
+            return not_modified_response(etag)
+
+    notices = await db.run_sync(notice_crud.get_notices, **list_kw)
+    etag = notice_list_etag(notices, total, params, before_id)
+    if settings.FAST_JSON:
+        return set_validators(FastJSONResponse(page_content([encode_notice_list(notice) for notice in notices],
+                                                            total, params)),
+                              etag)
+    set_validators(response, etag)
     response = [ notice.__dict__ for notice in notices ]
-    return paginate(response)
+    return Page.create(items=response, total=total, params=params)
+
+
+# Notice Search
+@router.get("/search", response_model=Page[NoticeSearchResult])
+async def search_notices(q: str = Query(..., min_length=1, max_length=200)
+                        , params: Params = Depends()
+                        , db: AsyncSession = Depends(get_db)):
+    results, total = await db.run_sync(notice_crud.search_notices,
+                                       query=q,
+                                       limit=params.size,
+                                       offset=(params.page - 1) * params.size)
+    return Page.create(items=results, total=total, params=params)
+
+
+# Notice Batch Read
+# ids=1,2,3 の順でnoticeを返す (存在しないidは含めない)。閲覧数は加算しない
+@router.get("/batch", response_model=List[Notice])
+async def read_notices_batch(ids: str = Query(..., min_length=1)
+                            , db: AsyncSession = Depends(get_db)):
+    try:
+        notice_ids = list(dict.fromkeys(int(notice_id) for notice_id in ids.split(",") if notice_id.strip()))
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid notice id")
+    if len(notice_ids) > settings.NOTICE_BATCH_MAX:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Too many ids (max {})".format(settings.NOTICE_BATCH_MAX))
+    return await db.run_sync(notice_crud.get_notices_by_ids, notice_ids=notice_ids)
 
 
 # Notice Create
@@ -37,91 +105,91 @@ async def read_all_by_notice(page: Optional[int] = 0, db: Session = Depends(get_
 async def create_notice(title: str=Form(...)
                         , content: str=Form(...)
                         , files: Optional[List[UploadFile]] = File(...)
-                        , Authorize: AuthJWT = Depends()
-                        , db: Session = Depends(get_db)):
-    current_user = Authorize.get_jwt_subject()
-    user = db.query(Users).filter(Users.username == current_user).first()
-
-    if not user or not user.is_staff:
+                        , user: CurrentUser = Depends(get_current_user)
+                        , db: AsyncSession = Depends(get_db)):
+    if not user.is_staff:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="権限がありません。")
 
     notice = NoticeCreate(title=title, content=content)
-    db_notice = notice_crud.create_notice(db=db, notice=notice, owner_id=user.id)
-
-    for file in files:
-        if file.filename == '':
-            continue
-        contents = await file.read()
-        f_name = '-'.join([datetime.now().strftime("%y%m%d_%H%M%S"), file.filename])
-        with open(os.path.join(FILE_DIR, f_name), "wb") as fp:
-            fp.write(contents)
-        f = NoticeFileCreate(path='/'.join([FILE_DIR, f_name]),
-                             file_name=file.filename, 
-                             file_size=os.path.getsize(FILE_DIR+'/'+f_name), 
-                             file_type=file.content_type, 
-                             notice_id=db_notice.id)
-        notice_crud.create_notice_file(db=db, notice_file=f)
-
-    return notice_crud.response_notice(db=db, notice_id=db_notice.id)
+    saved_files = await save_uploads(files)
+    db_notice = await db.run_sync(notice_crud.create_notice_with_files,
+                                  notice=notice,
+                                  owner_id=user.id,
+                                  files=saved_files)
+
+    return await db.run_sync(notice_crud.response_notice, notice_id=db_notice.id)
 
 # Notice Read
 @router.get("/{notice_id}", response_model=Notice)
-async def read_by_notice(notice_id: int, db: Session = Depends(get_db)):
-    notice = notice_crud.get_notice(db=db, notice_id=notice_id)
+async def read_by_notice(notice_id: int
+                        , request: Request
+                        , response: Response
+                        , viewer: Optional[str] = Depends(get_viewer)
+                        , db: AsyncSession = Depends(get_db)):
+    notice = await db.run_sync(notice_crud.response_notice, notice_id=notice_id)
     if not notice:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
 
-    return notice_crud.response_notice(db=db, notice_id=notice_id)
+    viewed = notice_crud.record_notice_view(notice_id=notice_id, viewer=viewer)
+    etag = notice_etag(notice)
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+
+    set_validators(response, etag)
+    if viewed:
+        notice = notice.copy(update={"views": notice.views + 1})
+    return notice
 
 
 # Notice Delete
 @router.delete("/{notice_id}")
 async def delete_notice(notice_id: int
-                        , user: dict = Depends(get_logged_in_user)
-                        , db: Session = Depends(get_db)):
+                        , user: CurrentUser = Depends(get_current_user)
+                        , db: AsyncSession = Depends(get_db)):
 
     if not notice_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid notice id")
 
-    notice = db.query(Notices).filter(Notices.owner_id == user.id).filter(Notices.id == notice_id).first()
+    notice = await db.run_sync(notice_crud.get_owned_notice, notice_id=notice_id, owner_id=user.id)
     if not notice:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad Request")
 
-    return notice_crud.delete_notice(db=db, notice_id=notice_id)
+    return await db.run_sync(notice_crud.delete_notice, notice_id=notice_id)
 
 
 # Notice Update
 @router.put("/{notice_id}", response_model=Notice)
 async def update_notice(notice_id: int
                         , notice: NoticeUpdate
-                        , user: dict = Depends(get_logged_in_user)
-                        , db: Session = Depends(get_db)):
+                        , user: CurrentUser = Depends(get_current_user)
+                        , db: AsyncSession = Depends(get_db)):
     if not notice_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid notice id")
     
-    user_id = get_user(username=user['current_user'], db=db).id
-    db_notice = db.query(Notices).filter(Notices.owner_id == user_id).filter(Notices.id == notice_id).first()
+    user_id = user.id
+    db_notice = await db.run_sync(notice_crud.get_owned_notice, notice_id=notice_id, owner_id=user_id)
     if not db_notice:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad Request")
 
-    return notice_crud.update_notice(db=db, notice_id=notice_id, owner_id=user_id, notice=notice)
+    return await db.run_sync(notice_crud.update_notice, notice_id=notice_id, owner_id=user_id, notice=notice)
 
 
 # Notice Comment Create
 @router.post("/{notice_id}/comment", response_model=Page[Comment])
 async def create_notice_comment(notice_id: int
                                 , comment: CommentCreate
-                                , user: dict = Depends(get_logged_in_user)
-                                , db: Session = Depends(get_db)):
+                                , params: Params = Depends()
+                                , user: CurrentUser = Depends(get_current_user)
+                                , db: AsyncSession = Depends(get_db)):
     
     if not comment.notice_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid notice id")
 
-    create = notice_crud.create_notice_comments(db=db, comment=comment, owner_id=user.id)
+    create = await db.run_sync(notice_crud.create_notice_comments, comment=comment, owner_id=user.id)
     if create["status"] != 200:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad Request")
 
-    return paginate(notice_crud.get_comments(db=db, notice_id=notice_id))
+    return await comment_page(db=db, notice_id=notice_id, params=params)
 
 
 # Notice Comment Update
@@ -129,97 +197,176 @@ async def create_notice_comment(notice_id: int
 async def update_notice_comment(notice_id: int
                                 , comment_id: int
                                 , comment: CommentBase
-                                , user: dict = Depends(get_logged_in_user)
-                                , db: Session = Depends(get_db)):
+                                , params: Params = Depends()
+                                , user: CurrentUser = Depends(get_current_user)
+                                , db: AsyncSession = Depends(get_db)):
     if not notice_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid notice id")
 
-    is_notice = db.query(Notices).filter(Notices.id == notice_id).first()
+    is_notice = await db.run_sync(notice_crud.exists_notice, notice_id=notice_id)
     if not is_notice:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad Request")
 
-    is_comment = notice_crud.get_comment(db=db, comment_id=comment_id, owner_id=user.id)
+    is_comment = await db.run_sync(notice_crud.get_comment, comment_id=comment_id, owner_id=user.id)
     if not is_comment:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad Request")
 
-    return paginate(notice_crud.update_comment(db=db, notice_id=notice_id, comment_id=comment_id, owner_id=user.id, comment= comment))
+    await db.run_sync(notice_crud.update_comment, notice_id=notice_id, comment_id=comment_id, owner_id=user.id, comment= comment)
+    return await comment_page(db=db, notice_id=notice_id, params=params)
 
 
 # Notice Comment Delete
 @router.delete("/{notice_id}/comment/{comment_id}", response_model=Page[Comment])
 async def delete_notice_comment(notice_id: int
                                 , comment_id: int
-                                , user: dict = Depends(get_logged_in_user)
-                                , db: Session = Depends(get_db)):
+                                , params: Params = Depends()
+                                , user: CurrentUser = Depends(get_current_user)
+                                , db: AsyncSession = Depends(get_db)):
     if not notice_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid notice id")
 
-    notice = db.query(Notices).filter(Notices.id == notice_id).first()
+    notice = await db.run_sync(notice_crud.exists_notice, notice_id=notice_id)
     if not notice:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad Request")
 
-    comment = notice_crud.get_comment(db=db, comment_id=comment_id, owner_id=user.id)
+    comment = await db.run_sync(notice_crud.get_comment, comment_id=comment_id, owner_id=user.id)
     if not comment:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Bad Request")
 
-    return paginate(notice_crud.delete_comment(db=db, notice_id=notice_id, comment_id=comment_id))
+    await db.run_sync(notice_crud.delete_comment, notice_id=notice_id, comment_id=comment_id)
+    return await comment_page(db=db, notice_id=notice_id, params=params)
+
+# Notice Events (SSE)
+# like/hate数の変化とcommentの作成/更新/削除をpushする (getLike/詳細/comment一覧のpollingの代わり)
+# 読み込みとの間のeventを落とさないよう先に購読し、streamの間はDB connectionを持たない
+@router.get("/{notice_id}/events")
+async def read_notice_events(notice_id: int
+                            , db: AsyncSession = Depends(get_db)):
+    subscriber = notice_events.subscribe(notice_id)
+    try:
+        notice = await db.run_sync(notice_crud.response_notice, notice_id=notice_id)
+    finally:
+        await db.close()
+    if not notice:
+        notice_events.unsubscribe(subscriber)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+    ready = {"type": "ready", "notice_id": notice_id, "like_cnt": notice.like_cnt, "hate_cnt": notice.hate_cnt}
+    return StreamingResponse(notice_event_stream(subscriber, ready),
+                             media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 
 # Comment paginate
 @router.get("/{notice_id}/comment", response_model=Page[Comment])
-async def read_all_by_comment(notice_id: int, page: Optional[int] = 0, db: Session = Depends(get_db)):
-    comments = notice_crud.get_comments(db=db, notice_id=notice_id)
-    return paginate(comments)
+async def read_all_by_comment(notice_id: int
+                            , params: Params = Depends()
+                            , before_id: Optional[int] = None
+                            , db: AsyncSession = Depends(get_db)):
+    return await comment_page(db=db, notice_id=notice_id, params=params, before_id=before_id)
+
+
+# 1ページ分のcommentをDBから取得する
+async def comment_page(db, notice_id: int, params: Params, before_id: Optional[int] = None):
+    comments, total = await db.run_sync(notice_crud.get_comments_page,
+                                        notice_id=notice_id,
+                                        limit=params.size,
+                                        offset=(params.page - 1) * params.size,
+                                        before_id=before_id)
+    if settings.FAST_JSON:
+        return FastJSONResponse(page_content([encode_comment(comment) for comment in comments], total, params))
+    return Page.create(items=comments, total=total, params=params)
 
 
 # getLike
 @router.post("/{notice_id}/getLike")
 async def get_like(notice_id: int
-                    , user: dict = Depends(get_logged_in_user)
-                    , db: Session = Depends(get_db)):
+                    , user: CurrentUser = Depends(get_current_user)
+                    , db: AsyncSession = Depends(get_db)):
     if not notice_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid notice id")
-    return notice_crud.get_notice_like_hate(db=db, notice_id=notice_id, owner_id=user.id)
+    return await db.run_sync(notice_crud.get_notice_like_hate, notice_id=notice_id, owner_id=user.id)
 
 
 # Notice Like Button evnet
 @router.post("/{notice_id}/like")
 async def update_notike_like_cnt(notice_id: int
-                                , user: dict = Depends(get_logged_in_user)
-                                , db: Session = Depends(get_db)):
+                                , user: CurrentUser = Depends(get_current_user)
+                                , db: AsyncSession = Depends(get_db)):
 
     if not notice_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid notice id")
 
-    db_like = notice_crud.get_notice_like_hate(db=db, notice_id=notice_id, owner_id=user.id)
-    if not db_like:
-        return notice_crud.create_notice_like(db=db, notice_id=notice_id, owner_id=user.id)
-
-    return notice_crud.update_notice_like(db=db, notice_id=notice_id, owner_id=user.id)
+    notice = await db.run_sync(notice_crud.toggle_notice_like, notice_id=notice_id, owner_id=user.id)
+    if notice is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return notice
 
 # Notice Hate Button evnet
 @router.post("/{notice_id}/hate")
-async def update_notike_like_cnt(notice_id: int
-                                , user: dict = Depends(get_logged_in_user)
-                                , db: Session = Depends(get_db)):
+async def update_notike_hate_cnt(notice_id: int
+                                , user: CurrentUser = Depends(get_current_user)
+                                , db: AsyncSession = Depends(get_db)):
 
     if not notice_id:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid notice id")
 
-    db_hate = notice_crud.get_notice_like_hate(db=db, notice_id=notice_id, owner_id=user.id)
-    if not db_hate:
-        return notice_crud.create_notice_hate(db=db, notice_id=notice_id, owner_id=user.id)
-
-    return notice_crud.update_notice_hate(db=db, notice_id=notice_id, owner_id=user.id)
+    notice = await db.run_sync(notice_crud.toggle_notice_hate, notice_id=notice_id, owner_id=user.id)
+    if notice is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return notice
 
 
 # Notice File Download
 @router.get("/file/download/{file_id}")
 async def notice_file_download(file_id: int
-                                , db: Session = Depends(get_db)):
-    f = notice_crud.download_notice_file(db=db, file_id=file_id)
-    file_name = f.file_name
-    file_path = f.path
-    return FileResponse(path=file_path, media_type='application/octet-stream', filename=file_name)
+                                , request: Request
+                                , db: AsyncSession = Depends(get_db)):
+    f = await db.run_sync(notice_crud.get_notice_file, file_id=file_id)
+    if not f:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+    path = local_file_path(f.path)
+    if path is None:
+        return await stream_blob(f)
+    size = await file_size(path)
+    if size is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+
+    response = RangeFileResponse(request,
+                                 path=path,
+                                 size=size,
+                                 filename=f.file_name,
+                                 etag=make_etag(f.id, f.file_size, f.checksum, f.updated_at),
+                                 last_modified=f.updated_at or f.created_at)
+
+    # 304や途中からのRange(レジューム)はdownload数に含めない
+    if response.status_code == 200 or (response.status_code == 206 and response.ranges[0][0] == 0):
+        notice_crud.download_notice_file(file_id=file_id)
+    return response
+
+
+
+# localにfileがないstorage (object storage) はRangeなしでstreamで送る
+async def stream_blob(f):
+    if not await run_in_threadpool(blob_storage.exists, f.path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    fp = await run_in_threadpool(blob_storage.open, f.path)
+
+    def chunks():
+        with fp:
+            while True:
+                chunk = fp.read(64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+
+    notice_crud.download_notice_file(file_id=f.id)
+    return StreamingResponse(chunks(),
+                             media_type="application/octet-stream",
+                             headers={"content-length": str(f.file_size),
+                                      "etag": make_etag(f.id, f.file_size, f.checksum, f.updated_at),
+                                      "content-disposition": "attachment; filename*=utf-8''{}".format(quote(f.file_name))})
 
 
 add_pagination(router)
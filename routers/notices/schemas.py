@@ -25,6 +25,7 @@ class NoticeFileCreate(BaseModel):
     file_size: int
     file_type: str
     file_download: int = 0
+    checksum: Optional[str] = None
     notice_id: int
     created_at: datetime = None
     updated_at: datetime = None
@@ -54,6 +55,15 @@ class NoticeBase(BaseModel):
 class NoticeList(NoticeBase):
     id: int
 
+class NoticeSearchResult(BaseModel):
+    id: int
+    title: str
+    title_highlight: str
+    snippets: List[str] = []
+    score: float
+    created_at: datetime = None
+    updated_at: datetime = None
+
 class CommentBase(BaseModel):
     comment: str
     created_at: datetime = None
@@ -97,3 +107,25 @@ class NoticeCreate(NoticeBase):
 
 class NoticeUpdate(NoticeBase):
     pass
+
+
+# NDJSON import/export (1行 = {"type": ..., ...})
+class NoticeExport(NoticeBase):
+    id: Optional[int] = None
+    views: Optional[int] = 0
+    owner_id: int
+    like_cnt: int = 0
+    hate_cnt: int = 0
+    comment_cnt: int = 0
+    deleted_at: Optional[datetime] = None
+
+class CommentExport(CommentCreate):
+    id: Optional[int] = None
+    owner_id: int
+
+class NoticeLikeExport(BaseModel):
+    id: Optional[int] = None
+    like: bool = False
+    hate: bool = False
+    owner_id: int
+    notice_id: int
@@ -3,11 +3,13 @@ from dotenv import load_dotenv
 from datetime import datetime, timedelta
 
 from ..models import Users
-from .schemas import UserCreate, UserSelect, UserLogin, Token
-from passlib.context import CryptContext
+from .schemas import UserCreate, UserSelect, UserLogin, Token, CurrentUser
+from .passwords import password_hasher
+from ..utils.cache import user_cache
 from typing import Optional
 from db.connection import get_db
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from fastapi_jwt_auth import AuthJWT
 from fastapi_jwt_auth.exceptions import AuthJWTException
@@ -17,7 +19,6 @@ from fastapi.security import OAuth2PasswordBearer
 load_dotenv()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
-password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 ACCESS_TOKEN_EXPIRE_MINUTES = os.getenv("JWT_ACCESS_TOKEN_EXPIRE_MINUTES")
 
 class User(BaseModel):
@@ -37,63 +38,134 @@ router = APIRouter(
     responses={401:{"user": "Not authorized"}}
 )
 
-# passwordをhashする
-def get_password_hash(password: str):
-    return password_context.hash(password)
+# passwordをhashする (bcryptはworker poolで実行する)
+async def get_password_hash(password: str):
+    return await password_hasher.hash(password)
 
 # passwordが保存されているhashと一致するかチェックする
-def verify_password(plain_password, hashed_password):
-    return password_context.verify(plain_password, hashed_password)
+# costが変わっている場合は新しいhashも返す
+async def verify_password(plain_password, hashed_password):
+    return await password_hasher.verify_and_update(plain_password, hashed_password)
 
 # userを認証してreturnする
-def authenticate_user(db, username: str, password: str):
-    user = db.query(Users).filter(Users.username == username).first()
+async def authenticate_user(db, username: str, password: str):
+    user = await db.run_sync(get_user, username=username)
 
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    verified, new_hash = await verify_password(password, user.hashed_password)
+    if not verified:
         return False
+    if new_hash:
+        await db.run_sync(update_password_hash, user_id=user.id, hashed_password=new_hash)
     return user
 
 # Login
 @router.post("/login")
-async def login(user: UserLogin, Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+async def login(user: UserLogin, Authorize: AuthJWT = Depends(), db: AsyncSession = Depends(get_db)):
 
     # DBに登録されているユーザーを確認する
-    db_user = authenticate_user(db, user.username, user.password)
+    db_user = await authenticate_user(db, user.username, user.password)
     if not db_user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="usernameまたはpasswordが間違います。")
 
-    access_token = Authorize.create_access_token(subject=user.username, expires_time=timedelta(minutes=10), user_claims={"id": db_user.id})
-    refresh_token = Authorize.create_refresh_token(subject=user.username)
+    access_token = Authorize.create_access_token(subject=user.username, expires_time=timedelta(minutes=10), user_claims=get_user_claims(db_user))
+    refresh_token = Authorize.create_refresh_token(subject=user.username, user_claims={"id": db_user.id})
 
     return {"access_token": access_token, "refresh_token": refresh_token}
 
+# tokenに入れるuser情報
+def get_user_claims(user):
+    return {"id": user.id, "is_staff": user.is_staff, "is_active": user.is_active}
+
+# user idでuserを取得する (TTL cache経由)
+async def load_user(db, user_id: int):
+    user = user_cache.get(user_id)
+    if user is None:
+        db_user = await db.run_sync(get_user_by_id, user_id=user_id)
+        if not db_user:
+            return None
+        user = UserSelect.from_orm(db_user)
+        user_cache.set(user_id, user)
+    return user
+
+# user情報が変わった場合はcacheを削除する
+def invalidate_user(user_id: int):
+    user_cache.delete(user_id)
+
+# tokenのuser idを返す (id claimがない古いtokenはusernameで検索する)
+async def get_token_user_id(Authorize: AuthJWT, db):
+    claims = Authorize.get_raw_jwt()
+    if claims.get("id") is not None:
+        return claims["id"]
+    db_user = await db.run_sync(get_user, username=Authorize.get_jwt_subject())
+    return db_user.id if db_user else None
+
+# 閲覧者の識別子 (tokenがあればuser id、なければIP)
+def get_viewer(request: Request, Authorize: AuthJWT = Depends()):
+    try:
+        Authorize.jwt_optional()
+        user_id = (Authorize.get_raw_jwt() or {}).get("id")
+    except Exception:
+        user_id = None
+    if user_id is not None:
+        return "user:{}".format(user_id)
+    return "ip:{}".format(request.client.host) if request.client else None
+
+# Loginしているユーザー (token claimから組み立て、DBは参照しない)
+async def get_current_user(Authorize: AuthJWT = Depends(), db: AsyncSession = Depends(get_db)):
+    try:
+        Authorize.jwt_required()
+
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+
+    claims = Authorize.get_raw_jwt()
+    if claims.get("id") is not None and "is_staff" in claims and "is_active" in claims:
+        return CurrentUser(id=claims["id"],
+                           username=claims["sub"],
+                           is_staff=claims["is_staff"],
+                           is_active=claims["is_active"])
+
+    user_id = await get_token_user_id(Authorize, db)
+    user = await load_user(db, user_id) if user_id is not None else None
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    return CurrentUser(**user.dict())
+
+# 管理者(is_staff)のみ
+async def get_staff_user(user: CurrentUser = Depends(get_current_user)):
+    if not user.is_staff:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
+    return user
+
 # Loginしているユーザー
 @router.get("/protected", response_model=UserSelect)
-async def get_logged_in_user(Authorize: AuthJWT = Depends(), db: Session = Depends(get_db)):
+async def get_logged_in_user(Authorize: AuthJWT = Depends(), db: AsyncSession = Depends(get_db)):
     try:
         Authorize.jwt_required()
 
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
-    current_user = Authorize.get_jwt_subject()
-    user = db.query(Users).filter(Users.username == current_user).first()
-    return user
+    user_id = await get_token_user_id(Authorize, db)
+    return await load_user(db, user_id) if user_id is not None else None
 
 
 # 新しいaccess_tokenを生成する
 @router.get("/refresh")
-async def create_refresh_token(db: Session = Depends(get_db), Authorize: AuthJWT = Depends()):
+async def create_refresh_token(db: AsyncSession = Depends(get_db), Authorize: AuthJWT = Depends()):
     try:
         Authorize.jwt_required()
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
     current_user = Authorize.get_jwt_subject()
-    db_user = db.query(Users).filter(Users.username == current_user).first()
-    access_token = Authorize.create_access_token(subject=current_user, expires_time=timedelta(minutes=10), user_claims={"id": db_user.id})
+    user_id = await get_token_user_id(Authorize, db)
+    db_user = await load_user(db, user_id) if user_id is not None else None
+    if not db_user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    access_token = Authorize.create_access_token(subject=current_user, expires_time=timedelta(minutes=10), user_claims=get_user_claims(db_user))
 
     return {"access_token": access_token}
 
@@ -101,10 +173,10 @@ async def create_refresh_token(db: Session = Depends(get_db), Authorize: AuthJWT
 @router.post("/register")
 async def register_user(user: UserCreate
                         , Authorize: AuthJWT = Depends()
-                        , db: Session = Depends(get_db)):
+                        , db: AsyncSession = Depends(get_db)):
     
-    validation1 = db.query(Users).filter(Users.username == user.username).first()
-    validation2 = db.query(Users).filter(Users.email == user.email).first()
+    validation1 = await db.run_sync(get_user, username=user.username)
+    validation2 = await db.run_sync(get_user_by_email, email=user.email)
 
     if validation1 is not None:
         raise HTTPException(status_code=400, detail="IDが既に存在します。")
@@ -114,19 +186,37 @@ async def register_user(user: UserCreate
     user_model = Users(
         email = user.email,
         username = user.username,
-        hashed_password = get_password_hash(user.password),
+        hashed_password = await get_password_hash(user.password),
         first_name = user.first_name,
         last_name = user.last_name,
         is_active = True,
         is_staff = False
     )
-    db.add(user_model)
-    db.commit()
-    
-    access_token = Authorize.create_access_token(subject=user.username)
-    refresh_token = Authorize.create_refresh_token(subject=user.username)
+    db_user = await db.run_sync(create_user, user_model=user_model)
+
+    # loginと同じclaimsを入れ、get_current_userでusersを読まずに済むようにする
+    access_token = Authorize.create_access_token(subject=user.username, expires_time=timedelta(minutes=10), user_claims=get_user_claims(db_user))
+    refresh_token = Authorize.create_refresh_token(subject=user.username, user_claims={"id": db_user.id})
 
     return {"access_token": access_token, "refresh_token": refresh_token}
 
-def get_user(username: str, db: Session):
+def get_user(db: Session, username: str):
     return db.query(Users).filter(Users.username == username).first()
+
+def get_user_by_id(db: Session, user_id: int):
+    return db.query(Users).filter(Users.id == user_id).first()
+
+def get_user_by_email(db: Session, email: str):
+    return db.query(Users).filter(Users.email == email).first()
+
+def create_user(db: Session, user_model: Users):
+    db.add(user_model)
+    db.commit()
+    db.refresh(user_model)
+    return user_model
+
+def update_password_hash(db: Session, user_id: int, hashed_password: str):
+    db.query(Users).filter(Users.id == user_id)\
+                   .update({Users.hashed_password: hashed_password}, synchronize_session=False)
+    db.commit()
+    invalidate_user(user_id)
@@ -0,0 +1,69 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from db.config import settings
+
+# BCRYPT_ROUNDSと異なるcostのhashはneeds_updateになり、login時に再hashされる
+password_context = CryptContext(schemes=["bcrypt"],
+                                deprecated="auto",
+                                bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+                                bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+                                bcrypt__max_rounds=settings.BCRYPT_ROUNDS)
+
+
+# process poolでも実行できるようにmodule levelの関数にする
+def _hash(password: str):
+    return password_context.hash(password)
+
+def _verify_and_update(plain_password: str, hashed_password: str):
+    return password_context.verify_and_update(plain_password, hashed_password)
+
+
+# bcryptをevent loopの外で実行するpool
+# 実行中+待機中がmax_pendingを超えたら503を返す
+class PasswordHasher:
+
+    def __init__(self, pool: str, workers: int, max_pending: int):
+        if pool == "process":
+            self._executor = ProcessPoolExecutor(max_workers=workers)
+        elif pool == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        else:
+            raise ValueError("Unknown password hash pool: {}".format(pool))
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="混雑しています。しばらくしてから再度お試しください。",
+                                headers={"Retry-After": "1"})
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str):
+        return await self._run(_hash, password)
+
+    # (一致したか, 再hashが必要な場合は新しいhash)
+    async def verify_and_update(self, plain_password: str, hashed_password: str):
+        return await self._run(_verify_and_update, plain_password, hashed_password)
+
+    def stats(self):
+        return {"pending": self.pending, "max_pending": self.max_pending, "rejected": self.rejected}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+password_hasher = PasswordHasher(pool=settings.PASSWORD_HASH_POOL,
+                                 workers=settings.PASSWORD_HASH_WORKERS,
+                                 max_pending=settings.PASSWORD_HASH_WORKERS + settings.PASSWORD_HASH_QUEUE)
@@ -26,6 +26,13 @@ class UserSelect(BaseModel):
     class Config:
         orm_mode = True
 
+#token claimから組み立てるLoginユーザー
+class CurrentUser(BaseModel):
+    id: int
+    username: str
+    is_active: bool
+    is_staff: bool
+
 #LOGIN用
 class UserLogin(BaseModel):
     username: str
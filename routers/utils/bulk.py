@@ -0,0 +1,153 @@
+import json
+import logging
+import time
+from datetime import date, datetime
+
+from pydantic import ValidationError
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from ..notices import schemas
+from ..models import Notices, Comments, NoticeLike
+
+logger = logging.getLogger(__name__)
+
+# type -> (table, import schema)
+# importはこの順(FKの親が先)でINSERTする
+BULK_TYPES = {
+    "notice": (Notices.__table__, schemas.NoticeExport),
+    "comment": (Comments.__table__, schemas.CommentExport),
+    "like": (NoticeLike.__table__, schemas.NoticeLikeExport),
+}
+
+MAX_REPORTED_ERRORS = 20
+
+
+def parse_types(types: str = None):
+    if not types:
+        return list(BULK_TYPES)
+    names = [name.strip() for name in types.split(",") if name.strip()]
+    unknown = [name for name in names if name not in BULK_TYPES]
+    if unknown:
+        raise ValueError("unknown types: {}".format(",".join(unknown)))
+    return [name for name in BULK_TYPES if name in names]
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+# Export
+# server-side cursor(stream_results)でchunk_size行ずつ読み、NDJSONの行をyieldする
+def export_ndjson(db: Session, types: list, chunk_size: int):
+    for name in types:
+        table, schema = BULK_TYPES[name]
+        columns = [table.c[field] for field in schema.__fields__ if field in table.c]
+        result = db.connection()\
+                   .execution_options(stream_results=True)\
+                   .execute(select(*columns).order_by(table.c.id))
+        for rows in result.partitions(chunk_size):
+            yield "".join(json.dumps(dict(row._mapping, type=name), default=_json_default, ensure_ascii=False) + "\n"
+                          for row in rows)
+
+
+class ImportStats:
+
+    def __init__(self):
+        self.lines = 0
+        self.inserted = {name: 0 for name in BULK_TYPES}
+        self.invalid = 0
+        self.errors = []
+        self.chunks = 0
+        self.started = time.perf_counter()
+
+    def error(self, line_no: int, message: str):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line_no, "error": message})
+
+    def as_dict(self):
+        elapsed = time.perf_counter() - self.started
+        total = sum(self.inserted.values())
+        return {"lines": self.lines,
+                "inserted": self.inserted,
+                "invalid": self.invalid,
+                "errors": self.errors,
+                "chunks": self.chunks,
+                "seconds": round(elapsed, 3),
+                "rows_per_second": round(total / elapsed, 1) if elapsed else None}
+
+
+# Import
+# 1行ずつpydantic schemaで検証し、chunk_size行ごとに1 transactionでまとめてINSERTする
+# 不正な行はskipしてstatsに記録する。INSERTに失敗したchunkはrollbackして例外を投げる
+class NdjsonImporter:
+
+    def __init__(self, db: Session, chunk_size: int, progress=None):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.stats = ImportStats()
+        self._pending = {name: [] for name in BULK_TYPES}
+        self._size = 0
+        self._buffer = b""
+
+    def add_line(self, line):
+        self.stats.lines += 1
+        try:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            line = line.strip()
+            if not line:
+                return
+            data = json.loads(line)
+            name = data.pop("type")
+            table, schema = BULK_TYPES[name]
+            row = schema.parse_obj(data).dict()
+        except (ValueError, KeyError, TypeError, AttributeError, ValidationError) as e:
+            self.stats.error(self.stats.lines, str(e) or e.__class__.__name__)
+            return
+        self._pending[name].append(row)
+        self._size += 1
+        if self._size >= self.chunk_size:
+            self.flush()
+
+    # request bodyなど任意の位置で切れたbyte列を受け取る
+    def feed(self, data: bytes):
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b"\n")
+        for line in lines:
+            self.add_line(line)
+
+    def flush(self):
+        if not self._size:
+            return
+        try:
+            for name, rows in self._pending.items():
+                if rows:
+                    self.db.execute(BULK_TYPES[name][0].insert(), rows)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        for name, rows in self._pending.items():
+            self.stats.inserted[name] += len(rows)
+            rows.clear()
+        self._size = 0
+        self.stats.chunks += 1
+        if self.progress is not None:
+            self.progress(self.stats)
+
+    def finish(self):
+        if self._buffer:
+            line, self._buffer = self._buffer, b""
+            self.add_line(line)
+        self.flush()
+        return self.stats.as_dict()
+
+
+def log_progress(stats: ImportStats):
+    logger.info("import progress: %d lines, inserted %s, invalid %d",
+                stats.lines, stats.inserted, stats.invalid)
@@ -0,0 +1,215 @@
+import fnmatch
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from db.config import settings
+
+
+class CacheBackend:
+
+    def get(self, key):
+        raise NotImplementedError
+
+    # generationを渡した場合、その後にdelete/clearされていればsetしない
+    def set(self, key, value, generation=None):
+        raise NotImplementedError
+
+    # missしたkeyをDBから読む前に取得し、setに渡す (対応しないbackendはNone)
+    def generation(self):
+        return None
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+# プロセス内のLRU cache (TTLとサイズ上限付き)
+# delete/clearのたびにgenerationを進め、DBを読んでいる間に無効化された古い値をsetしない
+class LRUCache(CacheBackend):
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_sets = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                self.stale_sets += 1
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "stale_sets": self.stale_sets,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+            }
+
+
+# redis互換clientのlocal代替 (get/set(ex=)/delete/scan_iterのみ)
+class LocalSharedClient:
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def scan_iter(self, match=None, count=None):
+        with self._lock:
+            keys = list(self._data)
+        return iter([key for key in keys if match is None or fnmatch.fnmatchcase(key, match)])
+
+
+# worker間で共有するcache (redis等のclientをそのまま渡す)
+# generationは扱わないので、DBを読んでいる間に他のworkerが無効化した古い値はttlの間残りうる
+class SharedCache(CacheBackend):
+
+    def __init__(self, client, prefix: str, ttl: float = 60):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return "{}:{}".format(self.prefix, key)
+
+    def get(self, key):
+        raw = self.client.get(self._key(key))
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(raw)
+
+    def set(self, key, value, generation=None):
+        self.client.set(self._key(key), pickle.dumps(value), ex=int(self.ttl))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    # このcacheのprefixのkeyだけを削除する (同じDBの他のkeyは残す)
+    def clear(self, batch_size: int = 500):
+        batch = []
+        for key in self.client.scan_iter(match=self._key("*"), count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                self.client.delete(*batch)
+                batch = []
+        if batch:
+            self.client.delete(*batch)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "backend": "shared",
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": None,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+            }
+
+
+def create_cache(prefix: str, backend: str, maxsize: int, ttl: float):
+    if backend == "memory":
+        return LRUCache(maxsize=maxsize, ttl=ttl)
+    if backend == "local":
+        return SharedCache(LocalSharedClient(), prefix=prefix, ttl=ttl)
+    if backend == "redis":
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND=redis requires the redis package")
+        return SharedCache(redis.Redis.from_url(settings.REDIS_URL), prefix=prefix, ttl=ttl)
+    raise ValueError("Unknown cache backend: {}".format(backend))
+
+
+notice_cache = create_cache(prefix="notice",
+                            backend=settings.NOTICE_CACHE_BACKEND,
+                            maxsize=settings.NOTICE_CACHE_SIZE,
+                            ttl=settings.NOTICE_CACHE_TTL)
+
+notice_count_cache = LRUCache(maxsize=1, ttl=settings.NOTICE_COUNT_TTL)
+
+user_cache = LRUCache(maxsize=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL)
@@ -0,0 +1,80 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+
+# metadataから強いETagを作る
+def make_etag(*parts):
+    digest = hashlib.sha1("-".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+    return '"{}"'.format(digest)
+
+
+def http_date(value: datetime):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return formatdate(value.timestamp(), usegmt=True)
+
+
+def parse_http_date(value: str):
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def strip_weak(etag: str):
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+# weak=Trueは弱い比較 (W/の有無を無視する)、Falseは強い比較 (弱いETagは一致しない)
+def etag_matches(header: str, etag: str, weak: bool):
+    if header.strip() == "*":
+        return True
+    if weak:
+        etag = strip_weak(etag)
+    elif etag.startswith("W/"):
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if weak:
+            candidate = strip_weak(candidate)
+        if candidate == etag:
+            return True
+    return False
+
+
+# 内容が同じとみなせる場合に使う弱いETag (viewsなどの表示用counterは含めない)
+def make_weak_etag(*parts):
+    return "W/" + make_etag(*parts)
+
+
+# If-None-Match (なければIf-Modified-Since) を満たす場合はTrue
+def not_modified(request: Request, etag: str, last_modified: datetime = None):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag, weak=True)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        since = parse_http_date(if_modified_since)
+        modified = parse_http_date(http_date(last_modified))
+        return since is not None and modified <= since
+    return False
+
+
+# ETag/Last-Modifiedを付け、毎回再検証させる
+def set_validators(response: Response, etag: str, last_modified: datetime = None):
+    response.headers["etag"] = etag
+    response.headers["cache-control"] = "no-cache"
+    if last_modified is not None:
+        response.headers["last-modified"] = http_date(last_modified)
+    return response
+
+
+def not_modified_response(etag: str, last_modified: datetime = None):
+    return set_validators(Response(status_code=304), etag, last_modified)
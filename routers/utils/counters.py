@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import bindparam, func
+from starlette.concurrency import run_in_threadpool
+
+from db.config import settings
+from db.session import SessionLocal
+from ..models import NoticeFile, Notices
+from .cache import LRUCache, notice_cache
+
+logger = logging.getLogger(__name__)
+
+
+# id単位の加算をメモリに貯め、まとめて UPDATE ... SET col = col + n する
+# on_flushにはDBへ反映したidのlistが渡される
+class CounterBuffer:
+
+    def __init__(self, name: str, column, on_flush=None):
+        self.name = name
+        self.column = column
+        self.table = column.table
+        self.on_flush = on_flush
+        self._pending = defaultdict(int)
+        self._inflight = {}
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.flushes = 0
+        self.flushed_total = 0
+        self.errors = 0
+        self.last_flush_at = None
+        self.last_flush_seconds = None
+
+    def incr(self, key: int, n: int = 1):
+        with self._lock:
+            self._pending[key] += n
+            if self._oldest is None:
+                self._oldest = time.time()
+
+    # まだDBに反映されていない加算分 (flush中のものを含む)
+    def pending(self, key: int):
+        with self._lock:
+            return self._pending.get(key, 0) + self._inflight.get(key, 0)
+
+    def pending_many(self, keys):
+        with self._lock:
+            return {key: self._pending.get(key, 0) + self._inflight.get(key, 0) for key in keys}
+
+    def _merge(self, pending: dict, oldest: float):
+        with self._lock:
+            for key, n in pending.items():
+                self._pending[key] += n
+            if oldest is not None and (self._oldest is None or oldest < self._oldest):
+                self._oldest = oldest
+
+    # flushは同時に1つだけ実行する
+    # shutdown時のflushは、cancelしたflusherのthreadで実行中のflushが終わるのを待ってから残りを反映する
+    def flush(self, db):
+        with self._flush_lock:
+            return self._flush(db)
+
+    def _flush(self, db):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+            oldest, self._oldest = self._oldest, None
+            self._inflight = pending
+        if not pending:
+            return 0
+
+        started = time.perf_counter()
+        stmt = self.table.update()\
+                    .where(self.table.c.id == bindparam("_id"))\
+                    .values({self.column.name: func.coalesce(self.column, 0) + bindparam("_n")})
+        try:
+            db.execute(stmt, [{"_id": key, "_n": n} for key, n in pending.items()])
+            db.commit()
+        except Exception:
+            db.rollback()
+            with self._lock:
+                self._inflight = {}
+            self._merge(pending, oldest)
+            self.errors += 1
+            raise
+
+        try:
+            if self.on_flush is not None:
+                self.on_flush(list(pending))
+        finally:
+            with self._lock:
+                self._inflight = {}
+
+        self.flushes += 1
+        self.flushed_total += sum(pending.values())
+        self.last_flush_at = time.time()
+        self.last_flush_seconds = time.perf_counter() - started
+        return len(pending)
+
+    def stats(self):
+        with self._lock:
+            pending_keys = len(self._pending)
+            pending_total = sum(self._pending.values())
+            lag = time.time() - self._oldest if self._oldest is not None else 0.0
+        return {
+            "pending_keys": pending_keys,
+            "pending_total": pending_total,
+            "lag_seconds": lag,
+            "flushes": self.flushes,
+            "flushed_total": self.flushed_total,
+            "errors": self.errors,
+            "last_flush_at": self.last_flush_at,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+
+# 同じnotice_id/viewerの閲覧をwindow秒の間は1回として数える
+class ViewTracker:
+
+    def __init__(self, counter: CounterBuffer, window: float, maxsize: int):
+        self.counter = counter
+        self.seen = LRUCache(maxsize=maxsize, ttl=window) if window > 0 else None
+        self.deduplicated = 0
+
+    def record(self, key: int, viewer: str = None):
+        if self.seen is not None and viewer is not None:
+            seen_key = (key, viewer)
+            if self.seen.get(seen_key) is not None:
+                self.deduplicated += 1
+                return False
+            self.seen.set(seen_key, True)
+        self.counter.incr(key)
+        return True
+
+
+# flushしたnoticeはcacheのviewsが古くなるので削除する
+def invalidate_notices(notice_ids):
+    for notice_id in notice_ids:
+        notice_cache.delete(notice_id)
+
+
+file_download_counter = CounterBuffer("file_download", NoticeFile.__table__.c.file_download)
+notice_view_counter = CounterBuffer("notice_views", Notices.__table__.c.views, on_flush=invalidate_notices)
+
+notice_view_tracker = ViewTracker(notice_view_counter,
+                                  window=settings.NOTICE_VIEW_DEDUP_WINDOW,
+                                  maxsize=settings.NOTICE_VIEW_DEDUP_SIZE)
+
+counters = [file_download_counter, notice_view_counter]
+
+
+def flush_counters():
+    db = SessionLocal()
+    try:
+        for counter in counters:
+            try:
+                counter.flush(db)
+            except Exception:
+                logger.exception("failed to flush %s counter", counter.name)
+    finally:
+        db.close()
+
+
+# COUNTER_FLUSH_INTERVAL秒ごとにflushするbackground task
+async def run_counter_flusher():
+    while True:
+        await asyncio.sleep(settings.COUNTER_FLUSH_INTERVAL)
+        await run_in_threadpool(flush_counters)
+
+
+def counter_stats():
+    stats = {counter.name: counter.stats() for counter in counters}
+    stats[notice_view_counter.name]["deduplicated"] = notice_view_tracker.deduplicated
+    return stats
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+
+from db.config import settings
+from .fast_json import dumps
+
+logger = logging.getLogger(__name__)
+
+
+# 1つのSSE接続の受信queue
+# queueが一杯になった(clientが読むのが遅い)場合は溜まったeventを捨てて"resync"だけを送り、
+# clientに状態を読み直させる (publishする側は待たない)
+class Subscriber:
+
+    def __init__(self, notice_id: int, maxsize: int):
+        self.notice_id = notice_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    # event loopのthreadで呼ばれる
+    def offer(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "resync", "notice_id": self.notice_id})
+            return False
+        return True
+
+    async def get(self):
+        return await self.queue.get()
+
+
+# notice単位のin-process pub/sub
+# publishはcrud (threadpoolのthread) から呼ばれるので、各subscriberのloopへcall_soon_threadsafeで渡す
+class NoticeEventHub:
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+        self.resyncs = 0
+
+    def subscribe(self, notice_id: int):
+        subscriber = Subscriber(notice_id, self.queue_size)
+        with self._lock:
+            self._subscribers[notice_id].add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.notice_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.notice_id]
+
+    def _offer(self, subscriber: Subscriber, event: dict):
+        if subscriber.offer(event):
+            self.delivered += 1
+        else:
+            self.resyncs += 1
+
+    # brokerから受け取ったeventをこのprocessのsubscriberに配る
+    def dispatch(self, event: dict):
+        self.published += 1
+        with self._lock:
+            subscribers = list(self._subscribers.get(event["notice_id"], ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.loop.call_soon_threadsafe(self._offer, subscriber, event)
+            except RuntimeError:
+                # loopが閉じている (shutdown中)
+                self.unsubscribe(subscriber)
+
+    def stats(self):
+        with self._lock:
+            notices = len(self._subscribers)
+            subscribers = sum(len(s) for s in self._subscribers.values())
+        return {
+            "notices": notices,
+            "subscribers": subscribers,
+            "published": self.published,
+            "delivered": self.delivered,
+            "resyncs": self.resyncs,
+        }
+
+
+# worker間でeventを配るbroker
+# publishしたeventを全worker (自分を含む) のdispatchに渡す。複数workerではRedis pub/subなどで実装する
+class EventBroker:
+
+    def __init__(self, dispatch):
+        self.dispatch = dispatch
+
+    def publish(self, event: dict):
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+# 1 process用: そのままこのprocessのhubに渡す
+class LocalBroker(EventBroker):
+
+    def publish(self, event: dict):
+        self.dispatch(event)
+
+
+BROKERS = {
+    "local": LocalBroker,
+}
+
+
+def create_broker(backend: str, dispatch):
+    if backend not in BROKERS:
+        raise ValueError("unknown EVENT_BROKER: {}".format(backend))
+    return BROKERS[backend](dispatch)
+
+
+notice_events = NoticeEventHub(queue_size=settings.EVENT_QUEUE_SIZE)
+event_broker = create_broker(settings.EVENT_BROKER, notice_events.dispatch)
+
+
+# commit後にcrudから呼ぶ (失敗してもrequestは失敗させない)
+def publish_notice_event(notice_id: int, type: str, **data):
+    try:
+        event_broker.publish(dict(type=type, notice_id=notice_id, **data))
+    except Exception:
+        logger.exception("failed to publish %s event for notice %d", type, notice_id)
+
+
+def format_sse(event: dict):
+    return b"event: " + event["type"].encode() + b"\ndata: " + dumps(event) + b"\n\n"
+
+
+# SSEのbody: 最初にreadyを送り、以降はeventをそのまま送る
+# EVENT_HEARTBEAT秒eventがなければcomment行を送り、切断されたproxy/clientを検出する
+async def notice_event_stream(subscriber: Subscriber, ready: dict):
+    try:
+        yield format_sse(ready)
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.get(), timeout=settings.EVENT_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield b": ping\n\n"
+                continue
+            yield format_sse(event)
+            if event["type"] == "deleted":
+                break
+    finally:
+        notice_events.unsubscribe(subscriber)
@@ -0,0 +1,65 @@
+import json
+from datetime import datetime
+from math import ceil
+
+from pydantic import BaseModel
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# JSONResponseと同じbyte列を返す (ensure_ascii=False, separators=(",", ":"))
+# orjsonはfloatの指数表記(1e+20)だけ書式が違うので、floatを含まないpayloadにのみ使う
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def _now():
+    return datetime.now().replace(microsecond=0)
+
+
+# response modelのfield順・型からDBの行をdictにする関数を作る
+# validatorを通さない代わりに、datetimeのvalidatorの既定値(現在時刻)だけは同じにする
+def compile_encoder(model):
+    steps = []
+    for name, field in model.__fields__.items():
+        if field.type_ is datetime:
+            if field.class_validators:
+                steps.append((name, lambda v: (v or _now()).isoformat()))
+            else:
+                steps.append((name, lambda v: v.isoformat() if v is not None else None))
+        elif field.type_ in (int, str, bool):
+            steps.append((name, None))
+        elif isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            raise TypeError("nested model {}.{} is not supported".format(model.__name__, name))
+        else:
+            raise TypeError("unsupported field {}.{}: {}".format(model.__name__, name, field.type_))
+
+    def encode(row):
+        getter = row.get if isinstance(row, dict) else lambda key: getattr(row, key, None)
+        return {name: convert(getter(name)) if convert else getter(name) for name, convert in steps}
+
+    encode.__name__ = "encode_{}".format(model.__name__)
+    return encode
+
+
+# fastapi_paginationのPage.createと同じfield順
+def page_content(items, total: int, params):
+    return {"items": items,
+            "total": total,
+            "page": params.page,
+            "size": params.size,
+            "pages": ceil(total / params.size) if total is not None else None}
@@ -0,0 +1,182 @@
+import os
+import re
+import stat
+import uuid
+from datetime import datetime
+from urllib.parse import quote
+
+import anyio
+from starlette.requests import Request
+from starlette.responses import Response
+
+from .conditional import http_date, etag_matches, not_modified
+
+CHUNK_SIZE = 64 * 1024
+MAX_RANGES = 16
+
+RANGE_RE = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+
+# Range headerを[(start, end), ...]に変換する (endを含む)
+# 形式が不正な場合はNone、満たせる範囲がない場合は[]を返す
+def parse_range(header: str, size: int):
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    ranges = []
+    for part in spec.split(","):
+        match = RANGE_RE.match(part)
+        if not match:
+            return None
+        first, last = match.groups()
+        if first == "" and last == "":
+            return None
+        if first == "":
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = min(int(last), size - 1) if last else size - 1
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def regular_file_size(path: str):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+
+# 通常fileのsizeを返す (存在しない場合はNone)
+# event loopを止めないよう、他のfile I/Oと同じくthreadで実行する
+async def file_size(path: str):
+    return await anyio.to_thread.run_sync(regular_file_size, path)
+
+
+# ETag/Last-Modifiedによる304とRange(206, multipart/byteranges)に対応したFileResponse
+# serverがzerocopysend拡張に対応していればsendfileで送信する
+class RangeFileResponse(Response):
+
+    # sizeはfile_size()で取得した値を渡す
+    def __init__(self, request: Request, path: str, size: int, filename: str, etag: str,
+                 last_modified: datetime = None, media_type: str = "application/octet-stream"):
+        super().__init__(status_code=200, media_type=None)
+        self.path = path
+        self.file_media_type = media_type
+        self.size = size
+        self.ranges = None
+        self.boundary = None
+
+        self.headers["accept-ranges"] = "bytes"
+        self.headers["etag"] = etag
+        if last_modified is not None:
+            self.headers["last-modified"] = http_date(last_modified)
+
+        if not_modified(request, etag, last_modified):
+            self.status_code = 304
+            del self.headers["content-length"]
+            return
+
+        quoted = quote(filename)
+        if quoted != filename:
+            self.headers["content-disposition"] = "attachment; filename*=utf-8''{}".format(quoted)
+        else:
+            self.headers["content-disposition"] = 'attachment; filename="{}"'.format(filename)
+
+        range_header = request.headers.get("range")
+        if range_header and self._if_range_matches(request, etag, last_modified):
+            ranges = parse_range(range_header, self.size)
+            if ranges == []:
+                self.status_code = 416
+                self.headers["content-range"] = "bytes */{}".format(self.size)
+                self.headers["content-length"] = "0"
+                return
+            if ranges:
+                self.ranges = ranges
+
+        if self.ranges is None:
+            self.headers["content-type"] = self.file_media_type
+            self.headers["content-length"] = str(self.size)
+        elif len(self.ranges) == 1:
+            start, end = self.ranges[0]
+            self.status_code = 206
+            self.headers["content-type"] = self.file_media_type
+            self.headers["content-range"] = "bytes {}-{}/{}".format(start, end, self.size)
+            self.headers["content-length"] = str(end - start + 1)
+        else:
+            self.status_code = 206
+            self.boundary = uuid.uuid4().hex
+            self.headers["content-type"] = "multipart/byteranges; boundary={}".format(self.boundary)
+            self.headers["content-length"] = str(sum(len(head) + end - start + 1
+                                                     for head, start, end in self._parts()) + len(self._closing()))
+
+    @staticmethod
+    def _if_range_matches(request: Request, etag: str, last_modified: datetime):
+        if_range = request.headers.get("if-range")
+        if if_range is None:
+            return True
+        if if_range.strip().startswith(('"', 'W/')):
+            return etag_matches(if_range, etag, weak=False)
+        return last_modified is not None and if_range.strip() == http_date(last_modified)
+
+    def _parts(self):
+        for index, (start, end) in enumerate(self.ranges):
+            head = ("{}--{}\r\ncontent-type: {}\r\ncontent-range: bytes {}-{}/{}\r\n\r\n"
+                    .format("\r\n" if index else "", self.boundary, self.file_media_type,
+                            start, end, self.size)).encode("latin-1")
+            yield head, start, end
+
+    def _closing(self):
+        return "\r\n--{}--\r\n".format(self.boundary).encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start",
+                    "status": self.status_code,
+                    "headers": self.raw_headers})
+        if self.status_code in (304, 416) or scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        async with await anyio.open_file(self.path, mode="rb") as fp:
+            if self.ranges is None:
+                await self._send_range(send, fp, 0, self.size - 1, zerocopy, more_body=False)
+            elif len(self.ranges) == 1:
+                start, end = self.ranges[0]
+                await self._send_range(send, fp, start, end, zerocopy, more_body=False)
+            else:
+                for head, start, end in self._parts():
+                    await send({"type": "http.response.body", "body": head, "more_body": True})
+                    await self._send_range(send, fp, start, end, zerocopy, more_body=True)
+                await send({"type": "http.response.body", "body": self._closing(), "more_body": False})
+
+    async def _send_range(self, send, fp, start: int, end: int, zerocopy: bool, more_body: bool):
+        count = end - start + 1
+        if count <= 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": more_body})
+            return
+        if zerocopy:
+            await send({"type": "http.response.zerocopysend",
+                        "file": fp.wrapped.fileno(),
+                        "offset": start,
+                        "count": count,
+                        "more_body": more_body})
+            return
+        await fp.seek(start)
+        while count > 0:
+            chunk = await fp.read(min(CHUNK_SIZE, count))
+            if not chunk:
+                break
+            count -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body or count > 0})
+        if count > 0 and not more_body:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
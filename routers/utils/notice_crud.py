@@ -1,39 +1,193 @@
+from collections import defaultdict
+from typing import List, Optional
 from sqlalchemy.orm import Session
-from sqlalchemy import func, case
+from sqlalchemy import func, select, text, update
 
 from ..notices import schemas
+from .cache import notice_cache, notice_count_cache
+from .counters import file_download_counter, notice_view_counter, notice_view_tracker
+from .events import publish_notice_event
+from .fast_json import compile_encoder
+from .search import get_search_index, render_highlight
+from db.migrations import ensure_index
 from ..models import Notices, Users, Comments, NoticeLike, NoticeFile
 from datetime import datetime
 
-# Listd
-def get_notices(db: Session):
-    return db.query(Notices).order_by(Notices.id.desc()).all()
+encode_comment = compile_encoder(schemas.Comment)
+
+# List
+# before_idを指定するとkeyset方式(id < before_id)、指定しないとLIMIT/OFFSET方式
+def get_notices(db: Session, limit: int, offset: int = 0, before_id: Optional[int] = None):
+    query = db.query(Notices).filter(Notices.deleted_at.is_(None))
+    if before_id is not None:
+        query = query.filter(Notices.id < before_id)
+        offset = 0
+    return query.order_by(Notices.id.desc())\
+                .limit(limit)\
+                .offset(offset)\
+                .all()
+
+# List (ETag用にidとupdated_atだけ取得する)
+def get_notice_versions(db: Session, limit: int, offset: int = 0, before_id: Optional[int] = None):
+    query = db.query(Notices.id, Notices.updated_at).filter(Notices.deleted_at.is_(None))
+    if before_id is not None:
+        query = query.filter(Notices.id < before_id)
+        offset = 0
+    return query.order_by(Notices.id.desc())\
+                .limit(limit)\
+                .offset(offset)\
+                .all()
+
+# List Count
+# MySQLはinformation_schemaの推定値を使い、COUNT(*)のフルスキャンを避ける
+# 推定値にはpurge前の削除済みの行も含まれるので、その件数 (ix_notices_deleted_atで数える) を引く
+def count_live_notices(db: Session):
+    if db.bind.dialect.name == 'mysql':
+        estimate = db.execute(text("SELECT TABLE_ROWS FROM information_schema.TABLES "
+                                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"),
+                              {"table": Notices.__tablename__}).scalar()
+        if estimate is not None:
+            deleted = db.query(func.count(Notices.id)).filter(Notices.deleted_at.isnot(None)).scalar()
+            return max(estimate - deleted, 0)
+    return db.query(func.count(Notices.id)).filter(Notices.deleted_at.is_(None)).scalar()
+
+# 一覧のページごとに数えないよう、NOTICE_COUNT_TTL秒の間は同じ値を使う
+def count_notices(db: Session):
+    generation = notice_count_cache.generation()
+    total = notice_count_cache.get("notices")
+    if total is None:
+        total = count_live_notices(db)
+        notice_count_cache.set("notices", total, generation=generation)
+    return total
 
 # Detail
-def get_notice(db: Session, notice_id: int):
+def notice_detail_query(db: Session):
     return db.query(Notices.id,
                     Notices.title,
                     Notices.content,
                     Notices.views,
-                    func.sum(case([(NoticeLike.like == True, 1)], else_=0)).label("like_cnt"),
-                    func.sum(case([(NoticeLike.hate == True, 1)], else_=0)).label("hate_cnt"),
+                    Notices.like_cnt,
+                    Notices.hate_cnt,
+                    Notices.comment_cnt,
                     Notices.created_at,
                     Notices.updated_at,
                     Users.username,
                     Users.is_active)\
             .join(Users, Notices.owner_id == Users.id)\
-            .join(NoticeLike, Notices.id == NoticeLike.notice_id, isouter=True)\
-            .filter(Notices.owner_id == Users.id)\
-            .filter(Notices.id == notice_id)\
-            .first()
+            .filter(Notices.deleted_at.is_(None))
+
+def get_notice(db: Session, notice_id: int):
+    return notice_detail_query(db).filter(Notices.id == notice_id).first()
+
+# Batch Detail
+# like/hate数はnoticesのcounterを使うので、noticeとuserのjoin 1回と添付fileのIN 1回で組み立てる
+# cacheにあるnoticeはDBを読まない。存在しない/削除済みのidは結果に含めない
+def get_notices_by_ids(db: Session, notice_ids: List[int]):
+    responses = {}
+    missing = []
+    for notice_id in notice_ids:
+        cached = notice_cache.get(notice_id)
+        if cached is None:
+            missing.append(notice_id)
+        else:
+            responses[notice_id] = cached
+
+    if missing:
+        generation = notice_cache.generation()
+        notices = notice_detail_query(db).filter(Notices.id.in_(missing)).all()
+        files = defaultdict(list)
+        if notices:
+            for f in db.query(NoticeFile.id,
+                              NoticeFile.path,
+                              NoticeFile.file_name,
+                              NoticeFile.file_size,
+                              NoticeFile.notice_id)\
+                       .filter(NoticeFile.notice_id.in_([notice.id for notice in notices]))\
+                       .order_by(NoticeFile.id.desc()):
+                files[f.notice_id].append(f)
+        for notice in notices:
+            response = notice_schema(notice, files[notice.id])
+            notice_cache.set(notice.id, response, generation=generation)
+            responses[notice.id] = response
+
+    # 未flushの閲覧数を足して返す
+    pending_views = notice_view_counter.pending_many(responses)
+    return [responses[notice_id] if not pending_views[notice_id]
+            else responses[notice_id].copy(update={"views": responses[notice_id].views + pending_views[notice_id]})
+            for notice_id in notice_ids if notice_id in responses]
+
+# Owner check
+def get_owned_notice(db: Session, notice_id: int, owner_id: int):
+    return db.query(Notices)\
+                .filter(Notices.owner_id == owner_id)\
+                .filter(Notices.id == notice_id)\
+                .filter(Notices.deleted_at.is_(None))\
+                .first()
+
+# Exists
+def exists_notice(db: Session, notice_id: int):
+    return db.query(Notices.id)\
+             .filter(Notices.id == notice_id)\
+             .filter(Notices.deleted_at.is_(None))\
+             .first() is not None
+
+# Like/Hate/Comment counter
+# 呼び出し元と同じtransactionで加算し、commitは呼び出し元で行う
+def update_notice_counts(db: Session, notice_id: int, like: int = 0, hate: int = 0, comment: int = 0):
+    db.query(Notices).filter(Notices.id == notice_id)\
+                     .update({Notices.like_cnt: Notices.like_cnt + like,
+                              Notices.hate_cnt: Notices.hate_cnt + hate,
+                              Notices.comment_cnt: Notices.comment_cnt + comment},
+                             synchronize_session=False)
+
+# Reconcile counters
+# notice_like/notice_commentから全noticeのcounterを再計算する
+def notice_counts_update():
+    like_cnt = select(func.count(NoticeLike.id))\
+                .where(NoticeLike.notice_id == Notices.id)\
+                .where(NoticeLike.like == True)\
+                .scalar_subquery()
+    hate_cnt = select(func.count(NoticeLike.id))\
+                .where(NoticeLike.notice_id == Notices.id)\
+                .where(NoticeLike.hate == True)\
+                .scalar_subquery()
+    comment_cnt = select(func.count(Comments.id))\
+                .where(Comments.notice_id == Notices.id)\
+                .scalar_subquery()
+    return update(Notices).values({Notices.like_cnt: like_cnt,
+                                   Notices.hate_cnt: hate_cnt,
+                                   Notices.comment_cnt: comment_cnt})
+
+def reconcile_notice_counts(db: Session):
+    updated = db.execute(notice_counts_update()).rowcount
+    db.commit()
+    return updated
 
 # Create
 def create_notice(db: Session, notice: schemas.NoticeCreate, owner_id: int):
     db_notice = Notices(**notice.dict(), owner_id=owner_id)
     db.add(db_notice)
+    db.flush()
+    get_search_index(db).notice_changed(db, db_notice.id, db_notice.title, db_notice.content)
     db.commit()
+    notice_count_cache.clear()
     db.refresh(db_notice)
-    return response_notice(db=db, notice_id=db_notice.id)
+    return db_notice
+
+# Create with files
+# noticeと添付fileを1つのtransactionで登録する
+def create_notice_with_files(db: Session, notice: schemas.NoticeCreate, owner_id: int, files: List[dict]):
+    db_notice = Notices(**notice.dict(), owner_id=owner_id)
+    db.add(db_notice)
+    db.flush()
+    for f in files:
+        notice_file = schemas.NoticeFileCreate(**f, notice_id=db_notice.id)
+        db.add(NoticeFile(**notice_file.dict()))
+    get_search_index(db).notice_changed(db, db_notice.id, db_notice.title, db_notice.content)
+    db.commit()
+    notice_count_cache.clear()
+    db.refresh(db_notice)
+    return db_notice
 
 # Notice File Create
 def create_notice_file(db: Session, notice_file:schemas.NoticeFileCreate):
@@ -41,6 +195,7 @@ def create_notice_file(db: Session, notice_file:schemas.NoticeFileCreate):
     db.add(db_notice_file)
     db.commit()
     db.refresh(db_notice_file)
+    notice_cache.delete(notice_file.notice_id)
     return db_notice_file
 
 # Notice File Read
@@ -53,21 +208,36 @@ def get_notice_files(db:Session, notice_id: str):
             .order_by(NoticeFile.id.desc())\
             .all()
 
+# Notice File Read
+def get_notice_file(db: Session, file_id: int):
+    return db.query(NoticeFile)\
+             .join(Notices, Notices.id == NoticeFile.notice_id)\
+             .filter(NoticeFile.id == file_id)\
+             .filter(Notices.deleted_at.is_(None))\
+             .first()
+
 # Notice File Download
-def download_notice_file(db: Session, file_id: int):
-    db_file = db.query(NoticeFile).filter(NoticeFile.id == file_id).first()
-    db_file.file_download = db_file.file_download + 1
-    db.add(db_file)
-    db.commit()
-    return db_file
+# download数はメモリに貯めて定期的にまとめてUPDATEする
+def download_notice_file(file_id: int):
+    file_download_counter.incr(file_id)
+
+# Notice View
+# 閲覧数はメモリに貯めて定期的にまとめてUPDATEする
+def record_notice_view(notice_id: int, viewer: Optional[str] = None):
+    return notice_view_tracker.record(notice_id, viewer)
 
 # Delete
+# deleted_atを設定して一覧/詳細から外すだけにし、comment/like/fileと行の削除はpurge workerに任せる
 def delete_notice(db: Session, notice_id: int):
-    db.query(Comments).filter(Comments.notice_id == notice_id).delete()
-    db.query(NoticeLike).filter(NoticeLike.notice_id == notice_id).delete()
-    db.query(NoticeFile).filter(NoticeFile.notice_id == notice_id).delete()
-    db.query(Notices).filter(Notices.id == notice_id).delete()
+    db.query(Notices).filter(Notices.id == notice_id)\
+                     .filter(Notices.deleted_at.is_(None))\
+                     .update({Notices.deleted_at: datetime.now().replace(microsecond=0)},
+                             synchronize_session=False)
+    get_search_index(db).notice_deleted(db, notice_id)
     db.commit()
+    notice_cache.delete(notice_id)
+    notice_count_cache.clear()
+    publish_notice_event(notice_id, "deleted")
     return {"status" : 200, "transaction": "Successful" }
 
 # Update
@@ -78,33 +248,88 @@ def update_notice(db: Session, notice_id: int, owner_id: int, notice: schemas.No
 
     db_notice.title = notice.title
     db_notice.content = notice.content
-    db_notice.updated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    db_notice.updated_at = datetime.now().replace(microsecond=0)
     db.add(db_notice)
+    get_search_index(db).notice_changed(db, notice_id, notice.title, notice.content)
     db.commit()
+    notice_cache.delete(notice_id)
 
-    return db_notice
+    return response_notice(db=db, notice_id=notice_id)
 
 # Comment Create
 def create_notice_comments(db: Session, comment: schemas.CommentCreate, owner_id: int):
+    if not exists_notice(db=db, notice_id=comment.notice_id):
+        return {"status" : 404, "transaction": "Not Found" }
     db_comment = Comments(**comment.dict(), owner_id=owner_id)
     db.add(db_comment)
+    update_notice_counts(db=db, notice_id=comment.notice_id, comment=1)
+    db.flush()
+    get_search_index(db).comment_changed(db, db_comment.id, comment.notice_id, comment.comment)
     db.commit()
+    publish_comment_event(db=db, notice_id=comment.notice_id, comment_id=db_comment.id, type="comment_created")
     return {"status" : 200, "transaction": "Successful" }
 
+# Search
+def search_notices(db: Session, query: str, limit: int, offset: int = 0):
+    results, total = get_search_index(db).search(db, query, limit, offset)
+    ids = [r["notice_id"] for r in results]
+    notices = {}
+    if ids:
+        notices = {n.id: n for n in db.query(Notices.id, Notices.title, Notices.created_at, Notices.updated_at)
+                                        .filter(Notices.id.in_(ids))
+                                        .filter(Notices.deleted_at.is_(None))}
+    items = []
+    for r in results:
+        notice = notices.get(r["notice_id"])
+        if notice is None:
+            continue
+        items.append(schemas.NoticeSearchResult(
+                        id = notice.id,
+                        title = notice.title,
+                        title_highlight = render_highlight(r["title"] or notice.title),
+                        snippets = [render_highlight(s) for s in r["snippets"]],
+                        score = r["score"],
+                        created_at = notice.created_at,
+                        updated_at = notice.updated_at
+                        ))
+    return items, total
+
 # Comment List
-def get_comments(db: Session, notice_id: int):
-    return db.query(Notices,
-                    Comments.id,
+# before_idを指定するとkeyset方式(id < before_id)、指定しないとLIMIT/OFFSET方式
+def comment_query(db: Session):
+    return db.query(Comments.id,
                     Comments.comment,
                     Comments.created_at,
                     Comments.updated_at,
                     Comments.owner_id,
                     Users.username)\
-            .join(Comments, Notices.id == Comments.notice_id)\
-            .join(Users, Users.id == Comments.owner_id)\
+             .join(Users, Users.id == Comments.owner_id)
+
+def get_comments(db: Session, notice_id: int, limit: int, offset: int = 0, before_id: Optional[int] = None):
+    query = comment_query(db).filter(Comments.notice_id == notice_id)
+    if before_id is not None:
+        query = query.filter(Comments.id < before_id)
+        offset = 0
+    return query.order_by(Comments.id.desc())\
+                .limit(limit)\
+                .offset(offset)\
+                .all()
+
+# Comment Count (notices.comment_cntを使う, 削除済みのnoticeはNone)
+def count_comments(db: Session, notice_id: int):
+    row = db.query(Notices.comment_cnt)\
             .filter(Notices.id == notice_id)\
-            .order_by(Comments.id.desc())\
-            .all()
+            .filter(Notices.deleted_at.is_(None))\
+            .first()
+    return None if row is None else row.comment_cnt or 0
+
+# Comment Page
+def get_comments_page(db: Session, notice_id: int, limit: int, offset: int = 0, before_id: Optional[int] = None):
+    total = count_comments(db=db, notice_id=notice_id)
+    if total is None:
+        return [], 0
+    comments = get_comments(db=db, notice_id=notice_id, limit=limit, offset=offset, before_id=before_id)
+    return comments, total
 
 
 # Comment Read
@@ -117,9 +342,17 @@ def get_comment(db: Session, comment_id: int, owner_id: int):
 
 # Comment Delete
 def delete_comment(db: Session, notice_id: int, comment_id: int):
-    db.query(Comments).filter(Comments.id == comment_id).delete()
+    deleted = db.query(Comments)\
+                .filter(Comments.id == comment_id)\
+                .filter(Comments.notice_id == notice_id)\
+                .delete()
+    update_notice_counts(db=db, notice_id=notice_id, comment=-deleted)
+    if deleted:
+        get_search_index(db).comment_deleted(db, comment_id)
     db.commit()
-    return get_comments(db=db, notice_id=notice_id)
+    if deleted:
+        publish_notice_event(notice_id, "comment_deleted", comment_id=comment_id)
+    return deleted
 
 
 # Comment update
@@ -129,10 +362,19 @@ def update_comment(db: Session, notice_id:int, comment_id:int, owner_id: int, co
                                     .filter(Comments.owner_id == owner_id)\
                                     .first()
     db_comment.comment = comment.comment
-    db_comment.updated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    db_comment.updated_at = datetime.now().replace(microsecond=0)
     db.add(db_comment)
+    get_search_index(db).comment_changed(db, comment_id, notice_id, comment.comment)
     db.commit()
-    return get_comments(db=db, notice_id=notice_id)
+    publish_comment_event(db=db, notice_id=notice_id, comment_id=comment_id, type="comment_updated")
+    return db_comment
+
+
+# Comment event (GET /notices/{id}/eventsの購読者へcomment一覧と同じ形で送る)
+def publish_comment_event(db: Session, notice_id: int, comment_id: int, type: str):
+    row = comment_query(db).filter(Comments.id == comment_id).first()
+    if row is not None:
+        publish_notice_event(notice_id, type, comment=encode_comment(row))
 
 
 # Check if Like or Hate exists
@@ -143,59 +385,145 @@ def get_notice_like_hate(db: Session, notice_id: int, owner_id: int):
                 .first()
 
 
-# Create Like
-def create_notice_like(db: Session, notice_id: int, owner_id: int):
-    db_like = NoticeLike(like=True, hate=False, notice_id=notice_id, owner_id=owner_id)
-    db.add(db_like)
+# Like/Hate toggle
+# 1 transactionで (1) 今の投票を元にcounterを更新 (2) (notice_id, owner_id)のuniqueでupsert (3) 結果を読む
+# (1)でnoticesの行がlockされるので、同じnoticeへの同時toggleは順番に処理される
+def toggle_notice_vote(db: Session, notice_id: int, owner_id: int, kind: str):
+    other = "hate" if kind == "like" else "like"
+    table = NoticeLike.__table__
+
+    def current(column):
+        return func.coalesce(select(column)
+                             .where(table.c.notice_id == notice_id)
+                             .where(table.c.owner_id == owner_id)
+                             .limit(1)
+                             .scalar_subquery(), 0)
+
+    counter = {"like": Notices.like_cnt, "hate": Notices.hate_cnt}
+    updated = db.query(Notices).filter(Notices.id == notice_id)\
+                               .filter(Notices.deleted_at.is_(None))\
+                               .update({counter[kind]: counter[kind] + 1 - 2 * current(table.c[kind]),
+                                        counter[other]: counter[other] - current(table.c[other])},
+                                       synchronize_session=False)
+    if not updated:
+        db.rollback()
+        return None
+
+    upsert_notice_vote(db=db, notice_id=notice_id, owner_id=owner_id, kind=kind)
+    vote = db.query(Notices.like_cnt, Notices.hate_cnt, table.c.like, table.c.hate)\
+             .join(table, table.c.notice_id == Notices.id)\
+             .filter(Notices.id == notice_id)\
+             .filter(table.c.owner_id == owner_id)\
+             .one()
     db.commit()
-    return response_notice(db=db, notice_id=notice_id)
-
-
-# Update Like
-def update_notice_like(db: Session, notice_id: int, owner_id: int):
-    db_like = db.query(NoticeLike)\
-                .filter(NoticeLike.notice_id == notice_id)\
-                .filter(NoticeLike.owner_id == owner_id)\
-                .first()
-    db_like.hate = False
-    db_like.like = False if db_like.like else True
-    db_like.updated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    db.add(db_like)
+    publish_notice_event(notice_id, "vote", like_cnt=vote.like_cnt, hate_cnt=vote.hate_cnt)
+
+    # cacheは他のworkerと揃えるため削除し、このresponseだけ手元のcacheを更新して返す
+    cached = notice_cache.get(notice_id)
+    notice_cache.delete(notice_id)
+    if cached is None:
+        return response_notice(db=db, notice_id=notice_id)
+    response = cached.copy(update={"like_cnt": vote.like_cnt, "hate_cnt": vote.hate_cnt})
+    pending_views = notice_view_counter.pending(notice_id)
+    if pending_views:
+        response = response.copy(update={"views": response.views + pending_views})
+    return response
+
+
+# kindの投票を反転し、もう一方は取り消す
+# MySQLはON DUPLICATE KEY UPDATE、SQLite/PostgreSQLはON CONFLICT DO UPDATE
+def upsert_notice_vote(db: Session, notice_id: int, owner_id: int, kind: str):
+    other = "hate" if kind == "like" else "like"
+    table = NoticeLike.__table__
+    values = {"notice_id": notice_id, "owner_id": owner_id, kind: 1, other: 0}
+    toggled = {kind: 1 - table.c[kind], other: 0}
+
+    dialect = db.bind.dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table).values(**values).on_duplicate_key_update(toggled)
+    elif dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(table).values(**values)\
+                            .on_conflict_do_update(index_elements=[table.c.notice_id, table.c.owner_id],
+                                                   set_=toggled)
+    else:
+        db_like = get_notice_like_hate(db=db, notice_id=notice_id, owner_id=owner_id)
+        if db_like is None:
+            db.add(NoticeLike(**values))
+        else:
+            setattr(db_like, kind, 0 if getattr(db_like, kind) else 1)
+            setattr(db_like, other, 0)
+        db.flush()
+        return
+    db.execute(stmt)
+
+
+# Like
+def toggle_notice_like(db: Session, notice_id: int, owner_id: int):
+    return toggle_notice_vote(db=db, notice_id=notice_id, owner_id=owner_id, kind="like")
+
+
+# Hate
+def toggle_notice_hate(db: Session, notice_id: int, owner_id: int):
+    return toggle_notice_vote(db=db, notice_id=notice_id, owner_id=owner_id, kind="hate")
+
+
+# 重複したnotice_likeの行を削除する (最新のidを残す)
+def delete_duplicate_notice_likes(db):
+    return db.execute(text(
+        "DELETE FROM notice_like WHERE id NOT IN ("
+        "SELECT id FROM (SELECT MAX(id) AS id FROM notice_like GROUP BY notice_id, owner_id) AS keep)"
+    )).rowcount
+
+
+# 重複を削除してunique indexを作り、counterを再計算する
+def dedupe_notice_likes(db: Session):
+    deleted = delete_duplicate_notice_likes(db)
     db.commit()
-    return response_notice(db=db, notice_id=notice_id)
-
-
-# Create hate
-def create_notice_hate(db: Session, notice_id: int, owner_id: int):
-    db_like = NoticeLike(like=False, hate=True, notice_id=notice_id, owner_id=owner_id)
-    db.add(db_like)
+    ensure_index(db.connection(), NoticeLike.__table__, "uq_notice_like_notice_owner")
     db.commit()
-    return response_notice(db=db, notice_id=notice_id)
-
-
-# Update hate
-def update_notice_hate(db: Session, notice_id: int, owner_id: int):
-    db_like = db.query(NoticeLike)\
-                .filter(NoticeLike.notice_id == notice_id)\
-                .filter(NoticeLike.owner_id == owner_id)\
-                .first()
-    db_like.hate = False if db_like.hate else True
-    db_like.like = False
-    db_like.updated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    db.add(db_like)
-    db.commit()
-    return response_notice(db=db, notice_id=notice_id)
+    reconcile_notice_counts(db=db)
+    return deleted
 
 
 # Notice schema
 def response_notice(db: Session, notice_id: int):
+    response = notice_cache.get(notice_id)
+    if response is None:
+        # 読んでいる間に更新(cacheの削除)があれば、古い内容なのでcacheしない
+        generation = notice_cache.generation()
+        response = build_notice(db=db, notice_id=notice_id)
+        if response is None:
+            return None
+        notice_cache.set(notice_id, response, generation=generation)
+
+    # 未flushの閲覧数を足して返す
+    pending_views = notice_view_counter.pending(notice_id)
+    if pending_views:
+        response = response.copy(update={"views": response.views + pending_views})
+    return response
+
+
+# Notice schemaをDBから組み立てる
+def build_notice(db: Session, notice_id: int):
     notice = get_notice(db=db, notice_id=notice_id)
-    notice_files = get_notice_files(db=db, notice_id=notice_id)
+    if not notice:
+        return None
+    return notice_schema(notice, get_notice_files(db=db, notice_id=notice_id))
+
 
+def notice_schema(notice, notice_files):
     return schemas.Notice(
                 id = notice.id,
                 title = notice.title,
                 content = notice.content,
+                views = notice.views or 0,
+                created_at = notice.created_at,
+                updated_at = notice.updated_at,
                 like_cnt = notice.like_cnt,
                 hate_cnt = notice.hate_cnt,
                 user = {"username": notice.username, "is_active": notice.is_active},
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import threading
+import time
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from db.config import settings
+from db.session import SessionLocal
+from ..models import Comments, NoticeFile, NoticeLike, Notices
+from .storage import release_blobs, release_legacy_files
+
+logger = logging.getLogger(__name__)
+
+
+# 削除済み(deleted_atあり)のnoticeのcomment/like/fileをbatch_size行ずつ削除し、最後にnoticeの行を削除する
+# 1 batch = 1 transactionなので、commentやlikeが多いnoticeでも長いlockを取らない
+# 失敗したnoticeはPURGE_RETRY_BASE秒から倍々(最大PURGE_RETRY_MAX秒)で間隔を空けて再試行する
+class NoticePurger:
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self._retry = {}
+        self._lock = threading.Lock()
+        self.backlog = None
+        self.purged = 0
+        self.rows_deleted = 0
+        self.files_deleted = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_run_at = None
+        self.last_run_seconds = None
+
+    def _delete_rows(self, db: Session, model, notice_id: int):
+        ids = [row.id for row in db.query(model.id)
+                                   .filter(model.notice_id == notice_id)
+                                   .limit(self.batch_size)]
+        if not ids:
+            return 0
+        db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        return len(ids)
+
+    # 行を削除してcommitしてから、他から参照されていないblob/fileを削除する
+    def _delete_files(self, db: Session, notice_id: int):
+        files = db.query(NoticeFile.id, NoticeFile.path, NoticeFile.checksum)\
+                  .filter(NoticeFile.notice_id == notice_id)\
+                  .limit(self.batch_size)\
+                  .all()
+        if not files:
+            return 0
+        db.query(NoticeFile).filter(NoticeFile.id.in_([f.id for f in files])).delete(synchronize_session=False)
+        db.commit()
+        deleted = release_blobs(db, [f.checksum for f in files if f.checksum])
+        deleted += release_legacy_files(db, [f.path for f in files if not f.checksum])
+        self.files_deleted += deleted
+        return len(files)
+
+    def purge_notice(self, db: Session, notice_id: int):
+        for step in (lambda: self._delete_rows(db, Comments, notice_id),
+                     lambda: self._delete_rows(db, NoticeLike, notice_id),
+                     lambda: self._delete_files(db, notice_id)):
+            while True:
+                deleted = step()
+                if not deleted:
+                    break
+                self.rows_deleted += deleted
+        self.rows_deleted += db.query(Notices)\
+                               .filter(Notices.id == notice_id)\
+                               .filter(Notices.deleted_at.isnot(None))\
+                               .delete(synchronize_session=False)
+        db.commit()
+
+    def _failed(self, notice_id: int, error: Exception):
+        with self._lock:
+            attempts = self._retry.get(notice_id, (0, 0))[0] + 1
+            delay = min(settings.PURGE_RETRY_MAX, settings.PURGE_RETRY_BASE * 2 ** (attempts - 1))
+            self._retry[notice_id] = (attempts, time.time() + delay)
+        self.errors += 1
+        self.last_error = "notice {}: {}: {}".format(notice_id, error.__class__.__name__, error)
+        logger.exception("failed to purge notice %d (attempt %d, retry in %.0fs)", notice_id, attempts, delay)
+
+    def _due(self, notice_id: int, now: float):
+        with self._lock:
+            retry = self._retry.get(notice_id)
+        return retry is None or retry[1] <= now
+
+    # 削除済みのnoticeを古い順に最大limit件purgeする
+    def run_once(self, db: Session, limit: int = 100):
+        started = time.perf_counter()
+        deleted = Notices.deleted_at.isnot(None)
+        self.backlog = db.query(func.count(Notices.id)).filter(deleted).scalar()
+        now = time.time()
+        with self._lock:
+            retrying = len(self._retry)
+        candidates = db.query(Notices.id)\
+                       .filter(deleted)\
+                       .order_by(Notices.deleted_at, Notices.id)\
+                       .limit(limit + retrying)\
+                       .all()
+        notice_ids = [row.id for row in candidates if self._due(row.id, now)][:limit]
+
+        purged = 0
+        for notice_id in notice_ids:
+            try:
+                self.purge_notice(db, notice_id)
+            except Exception as e:
+                db.rollback()
+                self._failed(notice_id, e)
+                continue
+            with self._lock:
+                self._retry.pop(notice_id, None)
+            purged += 1
+
+        self.purged += purged
+        self.backlog -= purged
+        self.last_run_at = time.time()
+        self.last_run_seconds = time.perf_counter() - started
+        return purged
+
+    def stats(self):
+        with self._lock:
+            retrying = len(self._retry)
+        return {
+            "backlog": self.backlog,
+            "retrying": retrying,
+            "purged": self.purged,
+            "rows_deleted": self.rows_deleted,
+            "files_deleted": self.files_deleted,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "last_run_at": self.last_run_at,
+            "last_run_seconds": self.last_run_seconds,
+        }
+
+
+notice_purger = NoticePurger(batch_size=settings.PURGE_BATCH_SIZE)
+
+
+def purge_deleted_notices(limit: int = 100):
+    db = SessionLocal()
+    try:
+        return notice_purger.run_once(db, limit=limit)
+    finally:
+        db.close()
+
+
+# PURGE_INTERVAL秒ごとに削除済みnoticeをpurgeするbackground task
+async def run_purge_worker():
+    while True:
+        await asyncio.sleep(settings.PURGE_INTERVAL)
+        try:
+            await run_in_threadpool(purge_deleted_notices)
+        except Exception:
+            logger.exception("notice purge failed")
@@ -0,0 +1,411 @@
+import html
+import logging
+import math
+import re
+import threading
+from collections import defaultdict
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from db.config import settings
+from ..models import Notices, Comments
+
+logger = logging.getLogger(__name__)
+
+MARK_START = "\x02"
+MARK_END = "\x03"
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def query_terms(query: str):
+    return [term for term in query.split() if term]
+
+
+# highlight用のmarkerをescapeした上で<mark>に置き換える
+def render_highlight(value: str):
+    return html.escape(value or "").replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+
+def mark_terms(value: str, terms):
+    if not value or not terms:
+        return value or ""
+    pattern = re.compile("|".join(re.escape(term) for term in terms), re.IGNORECASE)
+    return pattern.sub(lambda m: MARK_START + m.group(0) + MARK_END, value)
+
+
+# 最初に一致した語の前後width文字を切り出す
+def make_snippet(value: str, terms, width: int = 60):
+    if not value:
+        return ""
+    lowered = value.lower()
+    positions = [lowered.find(term.lower()) for term in terms]
+    positions = [p for p in positions if p >= 0]
+    start = max(min(positions) - width // 2, 0) if positions else 0
+    snippet = value[start:start + width]
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if start + width < len(value) else ""
+    return prefix + mark_terms(snippet, terms) + suffix
+
+
+# 英数字は単語単位、日本語など空白で区切られない文字列はbigramに分割する
+def tokenize(value: str):
+    tokens = []
+    for word in WORD_RE.findall((value or "").lower()):
+        if word.isascii() or len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class SearchIndex:
+
+    # index用のtable/indexを作る (migrationとmanage.py rebuild-search-indexから呼ぶ。requestの途中ではDDLを実行しない)
+    def create_schema(self, db):
+        pass
+
+    def rebuild(self, db: Session):
+        pass
+
+    # 以下はnotice_crudから同じtransaction内で呼ばれる
+    def notice_changed(self, db: Session, notice_id: int, title: str, content: str):
+        pass
+
+    def notice_deleted(self, db: Session, notice_id: int):
+        pass
+
+    def comment_changed(self, db: Session, comment_id: int, notice_id: int, comment: str):
+        pass
+
+    def comment_deleted(self, db: Session, comment_id: int):
+        pass
+
+    # [{"notice_id", "score", "title", "snippets"}], total
+    def search(self, db: Session, query: str, limit: int, offset: int):
+        raise NotImplementedError
+
+
+# MySQLのFULLTEXT index (ngram parser)
+# indexはDBが更新するのでincremental updateは不要
+class MySQLFullTextIndex(SearchIndex):
+
+    def create_schema(self, db):
+        existing = {row[0] for row in db.execute(text(
+            "SELECT INDEX_NAME FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND INDEX_TYPE = 'FULLTEXT'"))}
+        if "ft_notices_title_content" not in existing:
+            db.execute(text("ALTER TABLE notices ADD FULLTEXT INDEX ft_notices_title_content (title, content) WITH PARSER ngram"))
+        if "ft_notice_comment_comment" not in existing:
+            db.execute(text("ALTER TABLE notice_comment ADD FULLTEXT INDEX ft_notice_comment_comment (comment) WITH PARSER ngram"))
+
+    def search(self, db: Session, query: str, limit: int, offset: int):
+        terms = query_terms(query)
+        if not terms:
+            return [], 0
+        matches = """
+            SELECT id AS notice_id, MATCH(title, content) AGAINST (:q IN BOOLEAN MODE) * 2 AS score
+              FROM notices WHERE MATCH(title, content) AGAINST (:q IN BOOLEAN MODE) AND deleted_at IS NULL
+            UNION ALL
+            SELECT c.notice_id, MATCH(c.comment) AGAINST (:q IN BOOLEAN MODE) AS score
+              FROM notice_comment c JOIN notices n ON n.id = c.notice_id
+             WHERE MATCH(c.comment) AGAINST (:q IN BOOLEAN MODE) AND n.deleted_at IS NULL
+        """
+        boolean_query = " ".join('+"{}"'.format(term.replace('"', '')) for term in terms)
+        rows = db.execute(text("SELECT notice_id, SUM(score) AS score FROM ({}) m "
+                               "GROUP BY notice_id ORDER BY score DESC LIMIT :limit OFFSET :offset".format(matches)),
+                          {"q": boolean_query, "limit": limit, "offset": offset}).all()
+        total = db.execute(text("SELECT COUNT(DISTINCT notice_id) FROM ({}) m".format(matches)),
+                           {"q": boolean_query}).scalar()
+        return highlight_rows(db, rows, terms), total
+
+
+# SQLiteのFTS5 virtual table
+# noticeとcommentを1行ずつ登録し、notice単位でまとめて順位を付ける
+class SQLiteFTSIndex(SearchIndex):
+
+    def __init__(self, tokenizer: str):
+        self.tokenizer = tokenizer
+        self._ready = False
+
+    def _exists(self, db: Session):
+        if not self._ready:
+            self._ready = db.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'notice_search'")).first() is not None
+        return self._ready
+
+    # 作成した場合は全件を登録する
+    def create_schema(self, db):
+        if self._exists(db):
+            return
+        db.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS notice_search USING fts5("
+                        "title, body, notice_id UNINDEXED, kind UNINDEXED, "
+                        "tokenize = '{}')".format(self.tokenizer)))
+        self.rebuild(db)
+
+    # rowidはnoticeがid*2、commentがid*2+1 (rowidで更新・削除しscanを避ける)
+    def rebuild(self, db: Session):
+        db.execute(text("DELETE FROM notice_search"))
+        db.execute(text("INSERT INTO notice_search (rowid, title, body, notice_id, kind) "
+                        "SELECT id * 2, title, content, id, 'notice' FROM notices WHERE deleted_at IS NULL"))
+        db.execute(text("INSERT INTO notice_search (rowid, title, body, notice_id, kind) "
+                        "SELECT c.id * 2 + 1, '', c.comment, c.notice_id, 'comment' FROM notice_comment c "
+                        "JOIN notices n ON n.id = c.notice_id WHERE n.deleted_at IS NULL"))
+
+    # tableがまだない場合は作成後のrebuildで登録されるので何もしない
+    def notice_changed(self, db: Session, notice_id: int, title: str, content: str):
+        if not self._exists(db):
+            return
+        db.execute(text("DELETE FROM notice_search WHERE rowid = :rowid"), {"rowid": notice_id * 2})
+        db.execute(text("INSERT INTO notice_search (rowid, title, body, notice_id, kind) "
+                        "VALUES (:rowid, :title, :body, :notice_id, 'notice')"),
+                   {"rowid": notice_id * 2, "title": title, "body": content, "notice_id": notice_id})
+
+    # notice_commentを削除する前に呼ぶ
+    def notice_deleted(self, db: Session, notice_id: int):
+        if not self._exists(db):
+            return
+        db.execute(text("DELETE FROM notice_search WHERE rowid IN "
+                        "(SELECT id * 2 + 1 FROM notice_comment WHERE notice_id = :notice_id)"),
+                   {"notice_id": notice_id})
+        db.execute(text("DELETE FROM notice_search WHERE rowid = :rowid"), {"rowid": notice_id * 2})
+
+    def comment_changed(self, db: Session, comment_id: int, notice_id: int, comment: str):
+        if not self._exists(db):
+            return
+        db.execute(text("DELETE FROM notice_search WHERE rowid = :rowid"), {"rowid": comment_id * 2 + 1})
+        db.execute(text("INSERT INTO notice_search (rowid, title, body, notice_id, kind) "
+                        "VALUES (:rowid, '', :body, :notice_id, 'comment')"),
+                   {"rowid": comment_id * 2 + 1, "body": comment, "notice_id": notice_id})
+
+    def comment_deleted(self, db: Session, comment_id: int):
+        if not self._exists(db):
+            return
+        db.execute(text("DELETE FROM notice_search WHERE rowid = :rowid"), {"rowid": comment_id * 2 + 1})
+
+    def search(self, db: Session, query: str, limit: int, offset: int):
+        terms = query_terms(query)
+        if not terms:
+            return [], 0
+        if not self._exists(db):
+            logger.warning("notice_search table does not exist, run python manage.py migrate")
+            return [], 0
+        if self.tokenizer.split()[0] == "trigram" and any(len(term) < 3 for term in terms):
+            return self._search_like(db, terms, limit, offset)
+        fts_query = " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        params = {"q": fts_query, "limit": limit, "offset": offset}
+        # bm25は小さいほど関連度が高い (titleの重みを10倍にする)
+        # bm25は集計関数と同じSELECTで使えないため、LIMIT -1でsubqueryの平坦化を止める
+        rows = db.execute(text("SELECT notice_id, MIN(score) AS score FROM "
+                               "(SELECT notice_id, bm25(notice_search, 10.0, 1.0) AS score "
+                               "FROM notice_search WHERE notice_search MATCH :q LIMIT -1) "
+                               "GROUP BY notice_id ORDER BY score LIMIT :limit OFFSET :offset"), params).all()
+        total = db.execute(text("SELECT COUNT(DISTINCT notice_id) FROM notice_search WHERE notice_search MATCH :q"),
+                           params).scalar()
+        if not rows:
+            return [], total
+
+        ids = [row.notice_id for row in rows]
+        highlights = db.execute(text("SELECT notice_id, kind, "
+                                     "highlight(notice_search, 0, :start, :end) AS title, "
+                                     "snippet(notice_search, 1, :start, :end, '…', 16) AS snippet "
+                                     "FROM notice_search WHERE notice_search MATCH :q "
+                                     "AND notice_id IN ({}) ORDER BY rank".format(",".join(str(int(i)) for i in ids))),
+                                {"q": fts_query, "start": MARK_START, "end": MARK_END}).all()
+        titles = {}
+        snippets = defaultdict(list)
+        for row in highlights:
+            if row.kind == "notice":
+                titles[row.notice_id] = row.title
+            if MARK_START in (row.snippet or ""):
+                snippets[row.notice_id].append(row.snippet)
+        return [{"notice_id": row.notice_id,
+                 "score": -row.score,
+                 "title": titles.get(row.notice_id),
+                 "snippets": snippets[row.notice_id][:3]} for row in rows], total
+
+
+    # trigramは3文字未満の語をMATCHできないので、LIKEでnotice_searchを走査する (「本文」など2文字の日本語)
+    # 順位はnoticeの一致を2、commentの一致を1として合計する
+    def _search_like(self, db: Session, terms, limit: int, offset: int):
+        conditions = []
+        params = {"limit": limit, "offset": offset}
+        for i, term in enumerate(terms):
+            params["t{}".format(i)] = "%{}%".format(term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+            conditions.append("(title LIKE :t{0} ESCAPE '\\' OR body LIKE :t{0} ESCAPE '\\')".format(i))
+        matches = "SELECT notice_id, kind FROM notice_search WHERE " + " AND ".join(conditions)
+        rows = db.execute(text("SELECT notice_id, SUM(CASE kind WHEN 'notice' THEN 2 ELSE 1 END) AS score "
+                               "FROM ({}) GROUP BY notice_id ORDER BY score DESC, notice_id DESC "
+                               "LIMIT :limit OFFSET :offset".format(matches)), params).all()
+        total = db.execute(text("SELECT COUNT(DISTINCT notice_id) FROM ({})".format(matches)), params).scalar()
+        return highlight_rows(db, rows, terms), total
+
+
+# プロセス内の転置index (BM25)
+# 起動後の最初の検索で全件から作成し、以降はcrudから差分更新する
+class MemoryIndex(SearchIndex):
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self._postings = defaultdict(dict)
+        self._docs = {}
+        self._notice_docs = defaultdict(set)
+        self._total_length = 0
+        self._lock = threading.RLock()
+        self._ready = False
+
+    def rebuild(self, db: Session):
+        with self._lock:
+            self._postings.clear()
+            self._docs.clear()
+            self._notice_docs.clear()
+            self._total_length = 0
+            for notice in db.query(Notices.id, Notices.title, Notices.content)\
+                            .filter(Notices.deleted_at.is_(None))\
+                            .yield_per(1000):
+                self._add(("notice", notice.id), notice.id, notice.title, notice.content)
+            for comment in db.query(Comments.id, Comments.notice_id, Comments.comment)\
+                             .join(Notices, Notices.id == Comments.notice_id)\
+                             .filter(Notices.deleted_at.is_(None))\
+                             .yield_per(1000):
+                self._add(("comment", comment.id), comment.notice_id, "", comment.comment)
+            self._ready = True
+
+    def _add(self, key, notice_id: int, title: str, body: str):
+        self._remove(key)
+        # titleは2倍の重みにする
+        tokens = tokenize(title) * 2 + tokenize(body)
+        frequencies = defaultdict(int)
+        for token in tokens:
+            frequencies[token] += 1
+        for token, count in frequencies.items():
+            self._postings[token][key] = count
+        self._docs[key] = (notice_id, len(tokens), title, body)
+        self._notice_docs[notice_id].add(key)
+        self._total_length += len(tokens)
+
+    def _remove(self, key):
+        doc = self._docs.pop(key, None)
+        if doc is None:
+            return
+        self._total_length -= doc[1]
+        self._notice_docs[doc[0]].discard(key)
+        if not self._notice_docs[doc[0]]:
+            del self._notice_docs[doc[0]]
+        for token in set(tokenize(doc[2]) + tokenize(doc[3])):
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.pop(key, None)
+                if not postings:
+                    del self._postings[token]
+
+    def notice_changed(self, db: Session, notice_id: int, title: str, content: str):
+        with self._lock:
+            if self._ready:
+                self._add(("notice", notice_id), notice_id, title, content)
+
+    def notice_deleted(self, db: Session, notice_id: int):
+        with self._lock:
+            for key in list(self._notice_docs.get(notice_id, ())):
+                self._remove(key)
+
+    def comment_changed(self, db: Session, comment_id: int, notice_id: int, comment: str):
+        with self._lock:
+            if self._ready:
+                self._add(("comment", comment_id), notice_id, "", comment)
+
+    def comment_deleted(self, db: Session, comment_id: int):
+        with self._lock:
+            self._remove(("comment", comment_id))
+
+    def search(self, db: Session, query: str, limit: int, offset: int):
+        if not self._ready:
+            self.rebuild(db)
+        tokens = set(tokenize(query))
+        if not tokens:
+            return [], 0
+
+        with self._lock:
+            postings = [self._postings.get(token, {}) for token in tokens]
+            if not all(postings):
+                return [], 0
+            candidates = set.intersection(*(set(p) for p in postings))
+            doc_count = len(self._docs)
+            average_length = self._total_length / doc_count if doc_count else 0
+            scores = {}
+            for key in candidates:
+                notice_id, length, title, body = self._docs[key]
+                score = 0.0
+                for p in postings:
+                    tf = p[key]
+                    idf = math.log(1 + (doc_count - len(p) + 0.5) / (len(p) + 0.5))
+                    score += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / (average_length or 1)))
+                scores[notice_id] = max(scores.get(notice_id, 0.0), score)
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        rows = [_Row(notice_id, score) for notice_id, score in ranked[offset:offset + limit]]
+        return highlight_rows(db, rows, query_terms(query)), len(ranked)
+
+
+class _Row:
+
+    def __init__(self, notice_id, score):
+        self.notice_id = notice_id
+        self.score = score
+
+
+# title/contentを読み込み、Python側でhighlightする (MySQL/Memory用)
+def highlight_rows(db: Session, rows, terms):
+    if not rows:
+        return []
+    ids = [row.notice_id for row in rows]
+    notices = {n.id: n for n in db.query(Notices.id, Notices.title, Notices.content).filter(Notices.id.in_(ids))}
+    results = []
+    for row in rows:
+        notice = notices.get(row.notice_id)
+        if notice is None:
+            continue
+        snippet = make_snippet(notice.content, terms)
+        results.append({"notice_id": row.notice_id,
+                        "score": float(row.score),
+                        "title": mark_terms(notice.title, terms),
+                        "snippets": [snippet] if MARK_START in snippet else []})
+    return results
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_search_index(db: Session):
+    return search_index_for(db.bind.dialect.name)
+
+
+# SEARCH_BACKEND=autoの場合はDBのdialectで選ぶ
+def search_index_for(dialect: str):
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                backend = settings.SEARCH_BACKEND
+                if backend == "auto":
+                    backend = dialect if dialect in ("mysql", "sqlite") else "memory"
+                if backend == "mysql":
+                    _index = MySQLFullTextIndex()
+                elif backend == "sqlite":
+                    _index = SQLiteFTSIndex(tokenizer=settings.SEARCH_FTS_TOKENIZER)
+                elif backend == "memory":
+                    _index = MemoryIndex()
+                else:
+                    raise ValueError("Unknown search backend: {}".format(backend))
+    return _index
+
+
+# indexを全件から作り直す (manage.py rebuild-search-index, bulk import)
+def rebuild_search_index(db: Session):
+    index = get_search_index(db)
+    index.create_schema(db)
+    index.rebuild(db)
+    db.commit()
@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from db.config import settings
+from db.session import SessionLocal
+from ..models import NoticeFile
+
+logger = logging.getLogger(__name__)
+
+ROUTERS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_ROOT = os.path.join(ROUTERS_DIR, 'static', 'blobs')
+
+
+# 添付fileの保存先
+# keyは内容のsha256 (同じ内容のfileは1つだけ保存し、NoticeFile.pathにkeyを入れる)
+class BlobStorage:
+
+    # tmp_pathのfileをkeyで保存する (既にあればtmp_pathを削除し、最終更新時刻だけ更新する)
+    def put(self, tmp_path: str, key: str):
+        raise NotImplementedError
+
+    def exists(self, key: str):
+        raise NotImplementedError
+
+    # RangeFileResponseで送れるlocalのpath (localにない場合はNone)
+    def local_path(self, key: str):
+        raise NotImplementedError
+
+    def open(self, key: str):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    # 最終更新(put)からの経過秒数 (存在しない場合はNone)
+    def age(self, key: str):
+        raise NotImplementedError
+
+    # 保存されている全keyを返す (GC用)
+    def keys(self):
+        raise NotImplementedError
+
+    # 書き込み途中のfile置き場
+    def tmp_path(self):
+        raise NotImplementedError
+
+
+def shard(key: str, depth: int, width: int):
+    return [key[i * width:(i + 1) * width] for i in range(depth)] + [key]
+
+
+# root/ab/cd/abcd... のようにhashの先頭で分割したdirectoryに保存する
+class FileSystemStorage(BlobStorage):
+
+    def __init__(self, root: str, depth: int = 2, width: int = 2):
+        self.root = root
+        self.depth = depth
+        self.width = width
+        self.tmp_dir = os.path.join(root, "tmp")
+
+    def _path(self, key: str):
+        return os.path.join(self.root, *shard(key, self.depth, self.width))
+
+    def put(self, tmp_path: str, key: str):
+        path = self._path(key)
+        if os.path.exists(path):
+            os.utime(path)
+            os.remove(tmp_path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return True
+
+    def exists(self, key: str):
+        return os.path.isfile(self._path(key))
+
+    def local_path(self, key: str):
+        return self._path(key)
+
+    def open(self, key: str):
+        return open(self._path(key), "rb")
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def age(self, key: str):
+        try:
+            return time.time() - os.stat(self._path(key)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def keys(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root and "tmp" in dirnames:
+                dirnames.remove("tmp")
+            yield from filenames
+
+    def tmp_path(self):
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        return os.path.join(self.tmp_dir, uuid.uuid4().hex)
+
+
+# object storage clientのlocal代替 (put_object/get_object/head_object/delete_object/list_objectsのみ)
+class LocalObjectClient:
+
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def _path(self, key: str):
+        return os.path.join(self.root, key)
+
+    def put_object(self, key: str, path: str):
+        dest = self._path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with self._lock:
+            shutil.copyfile(path, dest + ".part")
+            os.replace(dest + ".part", dest)
+
+    def get_object(self, key: str):
+        return open(self._path(key), "rb")
+
+    def head_object(self, key: str):
+        try:
+            stat = os.stat(self._path(key))
+        except FileNotFoundError:
+            return None
+        return {"size": stat.st_size, "last_modified": stat.st_mtime}
+
+    def delete_object(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def list_objects(self, prefix: str):
+        base = self._path(prefix)
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                if not filename.endswith(".part"):
+                    yield os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, "/")
+
+
+# object storage (clientをそのまま渡す)
+# localにfileがないので、downloadはopen()からstreamで送る
+class ObjectStorage(BlobStorage):
+
+    def __init__(self, client, prefix: str, tmp_dir: str, depth: int = 2, width: int = 2):
+        self.client = client
+        self.prefix = prefix
+        self.tmp_dir = tmp_dir
+        self.depth = depth
+        self.width = width
+
+    def _key(self, key: str):
+        return "/".join([self.prefix] + shard(key, self.depth, self.width))
+
+    def put(self, tmp_path: str, key: str):
+        # 同じ内容なので上書きしてよい (最終更新時刻の更新も兼ねる)
+        created = self.client.head_object(self._key(key)) is None
+        try:
+            self.client.put_object(self._key(key), tmp_path)
+        finally:
+            os.remove(tmp_path)
+        return created
+
+    def exists(self, key: str):
+        return self.client.head_object(self._key(key)) is not None
+
+    def local_path(self, key: str):
+        return None
+
+    def open(self, key: str):
+        return self.client.get_object(self._key(key))
+
+    def delete(self, key: str):
+        self.client.delete_object(self._key(key))
+        return True
+
+    def age(self, key: str):
+        head = self.client.head_object(self._key(key))
+        return time.time() - head["last_modified"] if head else None
+
+    def keys(self):
+        for name in self.client.list_objects(self.prefix):
+            yield name.rsplit("/", 1)[-1]
+
+    def tmp_path(self):
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        return os.path.join(self.tmp_dir, uuid.uuid4().hex)
+
+
+def create_storage(backend: str, root: str):
+    if backend == "fs":
+        return FileSystemStorage(root,
+                                 depth=settings.STORAGE_SHARD_DEPTH,
+                                 width=settings.STORAGE_SHARD_WIDTH)
+    if backend == "local-object":
+        return ObjectStorage(LocalObjectClient(os.path.join(root, "objects")),
+                             prefix="blobs",
+                             tmp_dir=os.path.join(root, "tmp"),
+                             depth=settings.STORAGE_SHARD_DEPTH,
+                             width=settings.STORAGE_SHARD_WIDTH)
+    raise ValueError("Unknown storage backend: {}".format(backend))
+
+
+blob_storage = create_storage(backend=settings.STORAGE_BACKEND,
+                              root=settings.STORAGE_ROOT or DEFAULT_ROOT)
+
+
+# NoticeFile.pathからlocalのpathを返す (以前の絶対pathもそのまま使う)
+def local_file_path(path: str):
+    if os.path.isabs(path):
+        return path
+    return blob_storage.local_path(path)
+
+
+# NoticeFileから参照されていないkey
+def unreferenced_blobs(db: Session, keys):
+    keys = set(keys)
+    if not keys:
+        return set()
+    referenced = db.query(NoticeFile.checksum)\
+                   .filter(NoticeFile.checksum.in_(keys))\
+                   .distinct()\
+                   .all()
+    return keys - {row.checksum for row in referenced}
+
+
+# 参照がなくなったblobを削除する (noticeの削除後、commitしてから呼ぶ)
+# 直前にputされたblobは並行するuploadが参照する途中かもしれないので残し、gc_blobsに任せる
+def release_blobs(db: Session, keys, grace: float = None):
+    grace = settings.STORAGE_GC_GRACE if grace is None else grace
+    deleted = 0
+    for key in unreferenced_blobs(db, keys):
+        age = blob_storage.age(key)
+        if age is not None and age >= grace and blob_storage.delete(key):
+            deleted += 1
+    return deleted
+
+
+# blob導入前のfile (NoticeFile.pathがstatic/files以下の絶対path) で参照がなくなったものを削除する
+def release_legacy_files(db: Session, paths):
+    paths = {path for path in paths if path and os.path.isabs(path)}
+    if not paths:
+        return 0
+    referenced = {row.path for row in db.query(NoticeFile.path)
+                                        .filter(NoticeFile.path.in_(paths))
+                                        .distinct()}
+    deleted = 0
+    for path in paths - referenced:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        deleted += 1
+    return deleted
+
+
+# storage全体を走査して参照のないblobを削除する (manage.py gc-blobs)
+def gc_blobs(db: Session, batch_size: int = 1000, grace: float = None):
+    scanned = deleted = 0
+    batch = []
+    for key in blob_storage.keys():
+        batch.append(key)
+        if len(batch) >= batch_size:
+            scanned += len(batch)
+            deleted += release_blobs(db, batch, grace)
+            batch = []
+    if batch:
+        scanned += len(batch)
+        deleted += release_blobs(db, batch, grace)
+    return {"scanned": scanned, "deleted": deleted}
+
+
+def gc_blobs_once():
+    db = SessionLocal()
+    try:
+        return gc_blobs(db)
+    finally:
+        db.close()
+
+
+# STORAGE_GC_INTERVAL秒ごとに参照のないblobを削除するbackground task (0で無効)
+# 413で中断したuploadや、削除時にgrace内だったため残したblobはここで削除される
+async def run_blob_gc():
+    while True:
+        await asyncio.sleep(settings.STORAGE_GC_INTERVAL)
+        try:
+            result = await run_in_threadpool(gc_blobs_once)
+            if result["deleted"]:
+                logger.info("deleted %d unreferenced blobs (scanned %d)", result["deleted"], result["scanned"])
+        except Exception:
+            logger.exception("blob gc failed")
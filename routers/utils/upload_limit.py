@@ -0,0 +1,60 @@
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+
+# multipartのboundaryやfield部分の分 (file以外のformの値を含む)
+MULTIPART_OVERHEAD = 1024 * 1024
+
+
+# multipart/form-dataのrequest bodyをmax_size byteまでに制限するASGI middleware
+# Starletteはform()で全bodyをspoolしてからhandlerに渡すので、save_uploadsの上限だけでは
+# 大きすぎるbodyもdiskに書かれてしまう。Content-Lengthで先に断り、chunkedの場合は受信量を数えて途中で断る
+class UploadSizeLimitMiddleware:
+
+    def __init__(self, app, max_size: int):
+        self.app = app
+        self.max_size = max_size
+
+    def _too_large(self):
+        return HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, "ファイルサイズが大きすぎます。")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        if not headers.get("content-type", "").startswith("multipart/form-data"):
+            return await self.app(scope, receive, send)
+
+        content_length = headers.get("content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_size:
+            response = JSONResponse({"detail": "ファイルサイズが大きすぎます。"},
+                                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                    headers={"connection": "close"})
+            return await response(scope, receive, send)
+
+        received = 0
+        started = False
+
+        # handlerのform()の中で上限を超えたらHTTPExceptionにして、通常のerror responseにする
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_size:
+                    raise self._too_large()
+            return message
+
+        async def tracked_send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except HTTPException as e:
+            if started or e.status_code != status.HTTP_413_REQUEST_ENTITY_TOO_LARGE:
+                raise
+            response = JSONResponse({"detail": e.detail}, status_code=e.status_code, headers={"connection": "close"})
+            await response(scope, receive, send)
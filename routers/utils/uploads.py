@@ -0,0 +1,78 @@
+import hashlib
+import os
+from typing import List
+
+from fastapi import HTTPException, UploadFile, status
+from starlette.concurrency import run_in_threadpool
+
+from db.config import settings
+from .storage import blob_storage
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+# UploadFileを固定サイズのchunkでコピーし、サイズとsha256を同時に計算する
+# (threadpoolで実行する)
+def copy_upload(src, dest_path: str, limit: int):
+    checksum = hashlib.sha256()
+    size = 0
+    try:
+        with open(dest_path, "wb") as fp:
+            while True:
+                chunk = src.read(settings.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > limit:
+                    raise UploadTooLarge()
+                checksum.update(chunk)
+                fp.write(chunk)
+    except BaseException:
+        remove_files([dest_path])
+        raise
+    return size, checksum.hexdigest()
+
+
+def remove_files(paths: List[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# 一時fileにコピーしてからsha256をkeyにblob_storageへ保存する
+def store_upload(src, limit: int):
+    tmp_path = blob_storage.tmp_path()
+    size, checksum = copy_upload(src, tmp_path, limit)
+    try:
+        blob_storage.put(tmp_path, checksum)
+    except BaseException:
+        remove_files([tmp_path])
+        raise
+    return size, checksum
+
+
+# 添付fileを保存し、NoticeFile用の情報を返す (pathはblob_storageのkey)
+# file単位・request単位のサイズ上限を超えた場合は413を返す
+# 保存済みのblobは他のnoticeと共有している場合があるので、ここでは削除せずlifespanのrun_blob_gcに任せる
+async def save_uploads(files: List[UploadFile]):
+    saved = []
+    remaining = settings.UPLOAD_MAX_REQUEST_SIZE
+    try:
+        for file in files:
+            if file.filename == '':
+                continue
+            size, checksum = await run_in_threadpool(store_upload, file.file,
+                                                     min(settings.UPLOAD_MAX_FILE_SIZE, remaining))
+            remaining -= size
+            saved.append({"path": checksum,
+                          "file_name": file.filename,
+                          "file_size": size,
+                          "file_type": file.content_type,
+                          "checksum": checksum})
+    except UploadTooLarge:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="ファイルサイズが大きすぎます。")
+    return saved